@@ -0,0 +1,7 @@
+#!/bin/bash
+
+set -e
+set -x
+
+psql -U postgres -h localhost -d postgres -a -f media-migrations.pql
+echo "Schema has been migrated."
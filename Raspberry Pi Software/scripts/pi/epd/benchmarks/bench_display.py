@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Runs the epd7in5b_V2 display path against the virtual panel backend (see
+# epdconfig.Virtual), so it needs no hardware. Shows an image with display()
+# and the same planes with display_frame(), checks the panel ends up showing
+# exactly what was sent, and reports the SPI and GPIO traffic and the
+# simulated time of each step.
+#
+# Usage: python bench_display.py [image path] [PNG output directory]
+
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops
+
+EPD_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(EPD_DIR, "lib"))
+
+os.environ["MEMORYBOX_EPD_BACKEND"] = "virtual"
+if len(sys.argv) > 2:
+    os.environ["MEMORYBOX_EPD_VIRTUAL_DIR"] = sys.argv[2]
+
+from waveshare_epd import epd7in5b_V2, epdconfig
+
+
+def expected_frame(black_image, red_image):
+    frame = black_image.convert("RGB")
+    frame.paste((255, 0, 0), mask=ImageChops.invert(red_image.convert("L")))
+    return frame
+
+
+def report(name, func):
+    epdconfig.reset_stats()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    stats = epdconfig.stats()
+    print(
+        f"{name:<16} {stats['elapsed_ms'] / 1000:8.2f} s simulated "
+        f"({stats['busy_ms'] / 1000:6.2f} s busy), "
+        f"{stats['spi_bytes']:7d} SPI bytes in {stats['spi_transfers']:5d} transfers, "
+        f"{stats['gpio_toggles']:5d} GPIO toggles, {wall * 1000:7.1f} ms wall"
+    )
+
+
+def main():
+    image_path = (
+        sys.argv[1] if len(sys.argv) > 1 else os.path.join(EPD_DIR, "inputs/dog.jpeg")
+    )
+
+    epd = epd7in5b_V2.EPD()
+    with Image.open(image_path) as img:
+        source = img.convert("L").resize((epd.width, epd.height))
+    black_image = source.point(lambda p: 255 if p > 64 else 0).convert("1")
+    red_image = source.point(lambda p: 0 if 96 < p < 160 else 255).convert("1")
+    expected = expected_frame(black_image, red_image)
+
+    black_plane = epd.getbuffer_black(black_image)
+    red_plane = epd.getbuffer(red_image)
+
+    report("init", epd.init)
+    report("display", lambda: epd.display(epd.getbuffer(black_image), red_plane))
+    assert epdconfig.last_frame().tobytes() == expected.tobytes()
+    report("power off/on", lambda: (epd.power_off(), epd.power_on()))
+    report("display_frame", lambda: epd.display_frame(black_plane, red_plane))
+    assert epdconfig.last_frame().tobytes() == expected.tobytes()
+    report("Clear", epd.Clear)
+    report("sleep", epd.sleep)
+
+
+if __name__ == "__main__":
+    main()
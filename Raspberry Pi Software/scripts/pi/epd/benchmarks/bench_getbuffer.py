@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Times the epd7in5b_V2 frame preparation (getbuffer for both planes plus the
+# black plane re-inversion done by display()) on an 800x480 frame, comparing
+# the original per-byte Python loops with getbuffer_black() and getbuffer(),
+# which display_frame() sends as they are. Uses the virtual panel backend
+# unless MEMORYBOX_EPD_BACKEND says otherwise, so it runs off the Pi.
+#
+# Usage: python bench_getbuffer.py [image path] [repeats]
+
+import os
+import sys
+import timeit
+
+from PIL import Image
+
+EPD_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(EPD_DIR, "lib"))
+
+os.environ.setdefault("MEMORYBOX_EPD_BACKEND", "virtual")
+
+from waveshare_epd import epd7in5b_V2
+
+
+def legacy_getbuffer(image):
+    buf = bytearray(image.convert("1").tobytes("raw"))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def legacy_prepare(black_image, red_image):
+    imageblack = legacy_getbuffer(black_image)
+    imagered = legacy_getbuffer(red_image)
+    for i in range(len(imageblack)):
+        imageblack[i] ^= 0xFF
+    return imageblack, imagered
+
+
+def fast_prepare(epd, black_image, red_image):
+    return epd.getbuffer_black(black_image), epd.getbuffer(red_image)
+
+
+def main():
+    image_path = (
+        sys.argv[1] if len(sys.argv) > 1 else os.path.join(EPD_DIR, "inputs/dog.jpeg")
+    )
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    epd = epd7in5b_V2.EPD()
+    with Image.open(image_path) as img:
+        source = img.convert("L").resize((epd.width, epd.height))
+    black_image = source.convert("1")
+    red_image = source.point(lambda p: 255 if p > 96 else 0).convert("1")
+
+    legacy = legacy_prepare(black_image, red_image)
+    fast = fast_prepare(epd, black_image, red_image)
+    assert bytes(legacy[0]) == fast[0] and bytes(legacy[1]) == fast[1]
+
+    legacy_time = min(
+        timeit.repeat(
+            lambda: legacy_prepare(black_image, red_image), number=1, repeat=repeats
+        )
+    )
+    fast_time = min(
+        timeit.repeat(
+            lambda: fast_prepare(epd, black_image, red_image),
+            number=1,
+            repeat=repeats,
+        )
+    )
+
+    print(f"Frame: {epd.width}x{epd.height}, best of {repeats}")
+    print(f"Per-byte loops:   {legacy_time * 1000:9.2f} ms")
+    print(f"getbuffer_black:  {fast_time * 1000:9.2f} ms")
+    print(f"Speedup:          {legacy_time / fast_time:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
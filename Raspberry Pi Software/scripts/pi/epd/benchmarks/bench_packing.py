@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Times building a 1-bit frame buffer for a range of Waveshare panel sizes,
+# comparing the per-pixel loop the drivers used to run with
+# packing.pack_1bit(), for images in panel orientation and rotated. Then does
+# the same for the 2- and 4-bit colour panels and packing.pack_palette(), and
+# for the 4-gray panels' getbuffer_4Gray() and packing.pack_4gray(). Each
+# packed buffer is checked against the loop's before its time is reported.
+#
+# Usage: python bench_packing.py [repeats]
+
+import os
+import random
+import sys
+import timeit
+
+from PIL import Image
+
+EPD_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(EPD_DIR, "lib"))
+
+from waveshare_epd import packing
+
+# (name, width, height)
+PANELS = [
+    ("epd1in54", 200, 200),
+    ("epd2in13", 122, 250),
+    ("epd2in9", 128, 296),
+    ("epd4in2", 400, 300),
+    ("epd5in83_V2", 648, 480),
+    ("epd7in5b_HD", 880, 528),
+]
+
+# (name, width, height, colours, bits per pixel)
+COLOR_PANELS = [
+    (
+        "epd2in13g",
+        122,
+        250,
+        ((0, 0, 0), (255, 255, 255), (255, 255, 0), (255, 0, 0)),
+        2,
+    ),
+    (
+        "epd4in37g",
+        512,
+        368,
+        ((0, 0, 0), (255, 255, 255), (255, 255, 0), (255, 0, 0)),
+        2,
+    ),
+    (
+        "epd7in3f",
+        800,
+        480,
+        (
+            (0, 0, 0),
+            (255, 255, 255),
+            (0, 255, 0),
+            (0, 0, 255),
+            (255, 0, 0),
+            (255, 255, 0),
+            (255, 128, 0),
+        ),
+        4,
+    ),
+]
+
+
+def legacy_getbuffer(image, width, height):
+    linewidth = (width + 7) // 8
+    buf = [0xFF] * (linewidth * height)
+    image_monocolor = image.convert("1")
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    if imwidth == width and imheight == height:
+        for y in range(imheight):
+            for x in range(imwidth):
+                if pixels[x, y] == 0:
+                    buf[x // 8 + y * linewidth] &= ~(0x80 >> (x % 8))
+    elif imwidth == height and imheight == width:
+        for y in range(imheight):
+            for x in range(imwidth):
+                newx = y
+                newy = height - x - 1
+                if pixels[x, y] == 0:
+                    buf[newx // 8 + newy * linewidth] &= ~(0x80 >> (y % 8))
+    return buf
+
+
+# (name, width, height, transpose for rotated images)
+GRAY_PANELS = [
+    ("epd2in7", 176, 264, Image.ROTATE_90),
+    ("epd3in7", 280, 480, Image.ROTATE_90),
+    ("epd4in2", 400, 300, Image.TRANSPOSE),
+]
+
+
+def legacy_getbuffer_color(image, width, height, colors, bits):
+    pal_image = Image.new("P", (1, 1))
+    pal_image.putpalette(sum(colors, ()) + (0, 0, 0) * (256 - len(colors)))
+    if image.size != (width, height):
+        image = image.rotate(90, expand=True)
+    indices = image.convert("RGB").quantize(palette=pal_image).tobytes("raw")
+
+    per_byte = 8 // bits
+    linewidth = (width + per_byte - 1) // per_byte
+    buf = [0x00] * (linewidth * height)
+    for y in range(height):
+        for x in range(width):
+            shift = 8 - bits * (x % per_byte + 1)
+            buf[x // per_byte + y * linewidth] |= indices[x + y * width] << shift
+    return buf
+
+
+def legacy_getbuffer_4gray(image, width, height, rotate):
+    buf = [0xFF] * (width // 4 * height)
+    image_monocolor = image.convert("L")
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    for y in range(imheight):
+        for x in range(imwidth):
+            if pixels[x, y] == 0xC0:
+                pixels[x, y] = 0x80
+            elif pixels[x, y] == 0x80:
+                pixels[x, y] = 0x40
+            if imwidth == width:
+                newx, newy = x, y
+            elif rotate == Image.TRANSPOSE:
+                newx, newy = y, x
+            else:
+                newx, newy = y, height - x - 1
+            shift = 6 - 2 * (newx % 4)
+            buf[(newx + newy * width) // 4] &= ~(0x03 << shift)
+            buf[(newx + newy * width) // 4] |= (pixels[x, y] >> 6) << shift
+    return buf
+
+
+def random_image(size, rng):
+    # Already mode '1', like an image drawn for the panel, so the times are
+    # for packing rather than for PIL's dithering
+    data = bytes(rng.getrandbits(8) for _ in range(size[0] * size[1]))
+    return Image.frombytes("L", size, data).point(lambda p: p & 0x80).convert("1")
+
+
+def random_color_image(size, rng):
+    data = bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3))
+    return Image.frombytes("RGB", size, data)
+
+
+def random_gray_image(size, rng):
+    # Mostly the four levels the panels show, as a 4-gray image would be
+    levels = (0x00, 0x80, 0xC0, 0xFF, 0x5A)
+    data = bytes(rng.choice(levels) for _ in range(size[0] * size[1]))
+    return Image.frombytes("L", size, data)
+
+
+def best_time(func, repeats):
+    return min(timeit.repeat(func, number=1, repeat=repeats))
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = random.Random(0)
+
+    print(f"Best of {repeats}")
+    for name, width, height in PANELS:
+        for orientation, size in (
+            ("panel", (width, height)),
+            ("rotated", (height, width)),
+        ):
+            image = random_image(size, rng)
+
+            legacy = legacy_getbuffer(image, width, height)
+            packed = packing.pack_1bit(image, width, height)
+            assert bytes(legacy) == bytes(packed), (name, orientation)
+
+            legacy_time = min(
+                timeit.repeat(
+                    lambda: legacy_getbuffer(image, width, height),
+                    number=1,
+                    repeat=repeats,
+                )
+            )
+            packed_time = min(
+                timeit.repeat(
+                    lambda: packing.pack_1bit(image, width, height),
+                    number=1,
+                    repeat=repeats,
+                )
+            )
+            print(
+                f"{name:<12} {width:4d}x{height:<4d} {orientation:<8} "
+                f"loop: {legacy_time * 1000:8.2f} ms  "
+                f"packed: {packed_time * 1000:6.2f} ms  "
+                f"{legacy_time / packed_time:6.0f}x"
+            )
+
+    for name, width, height, colors, bits in COLOR_PANELS:
+        for orientation, size in (
+            ("panel", (width, height)),
+            ("rotated", (height, width)),
+        ):
+            image = random_color_image(size, rng)
+
+            legacy = legacy_getbuffer_color(image, width, height, colors, bits)
+            packed = packing.pack_palette(image, width, height, colors, bits)
+            assert bytes(legacy) == bytes(packed), (name, orientation)
+
+            legacy_time = best_time(
+                lambda: legacy_getbuffer_color(image, width, height, colors, bits),
+                repeats,
+            )
+            packed_time = best_time(
+                lambda: packing.pack_palette(image, width, height, colors, bits),
+                repeats,
+            )
+            print(
+                f"{name:<12} {width:4d}x{height:<4d} {orientation:<8} "
+                f"loop: {legacy_time * 1000:8.2f} ms  "
+                f"packed: {packed_time * 1000:6.2f} ms  "
+                f"{legacy_time / packed_time:6.0f}x"
+            )
+
+    for name, width, height, rotate in GRAY_PANELS:
+        for orientation, size in (
+            ("panel", (width, height)),
+            ("rotated", (height, width)),
+        ):
+            image = random_gray_image(size, rng)
+
+            legacy = legacy_getbuffer_4gray(image, width, height, rotate)
+            packed = packing.pack_4gray(image, width, height, rotate)
+            assert bytes(legacy) == bytes(packed), (name, orientation)
+
+            legacy_time = best_time(
+                lambda: legacy_getbuffer_4gray(image, width, height, rotate), repeats
+            )
+            packed_time = best_time(
+                lambda: packing.pack_4gray(image, width, height, rotate), repeats
+            )
+            print(
+                f"{name:<12} {width:4d}x{height:<4d} {orientation:<8} "
+                f"loop: {legacy_time * 1000:8.2f} ms  "
+                f"packed: {packed_time * 1000:6.2f} ms  "
+                f"{legacy_time / packed_time:6.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+# Times dither.floyd_steinberg_parallel() with 1 to N worker processes on
+# random frames of a few sizes. Each result is checked against the serial
+# floyd_steinberg() before its time is reported.
+#
+# Usage: python bench_parallel_dither.py [max workers] [repeats]
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+EPD_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(EPD_DIR)
+
+import dither
+
+SIZES = [(800, 480), (1600, 960), (3200, 1920)]
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rng = np.random.default_rng(0)
+
+    print(f"{os.cpu_count()} cores, best of {repeats}")
+    for width, height in SIZES:
+        pixels = rng.integers(0, 256, (height, width, 3)).astype(np.float32)
+        serial = dither.floyd_steinberg(pixels)
+        serial_time = min(
+            timeit.repeat(
+                lambda: dither.floyd_steinberg(pixels), number=1, repeat=repeats
+            )
+        )
+        print(f"{width}x{height}  serial: {serial_time * 1000:9.1f} ms")
+
+        for workers in range(1, max_workers + 1):
+            result = dither.floyd_steinberg_parallel(pixels, workers=workers)
+            assert np.array_equal(result, serial), f"{workers} workers differ"
+            parallel_time = min(
+                timeit.repeat(
+                    lambda: dither.floyd_steinberg_parallel(pixels, workers=workers),
+                    number=1,
+                    repeat=repeats,
+                )
+            )
+            print(
+                f"{width}x{height}  {workers} workers: {parallel_time * 1000:9.1f} ms"
+                f"  ({serial_time / parallel_time:.2f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
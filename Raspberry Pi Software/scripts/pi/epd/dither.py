@@ -0,0 +1,356 @@
+import multiprocessing
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from palette_lut import nearest_palette_index, palette_lut
+
+# Palette indices. The order matches the inks on the 7.5" red/black/white panel.
+WHITE = 0
+BLACK = 1
+RED = 2
+
+PALETTE = np.array(
+    [
+        [255, 255, 255],
+        [0, 0, 0],
+        [255, 0, 0],
+    ],
+    dtype=np.float32,
+)
+
+
+# Bands in floyd_steinberg_parallel() are at least this tall, and workers
+# report their progress to the band below every PUBLISH_STEPS steps.
+MIN_PARALLEL_BAND_ROWS = 16
+PUBLISH_STEPS = 8
+
+
+def floyd_steinberg(pixels, palette=PALETTE):
+    """Floyd-Steinberg error diffusion of an (height, width, 3) RGB array.
+
+    Returns a (height, width) uint8 array of indices into ``palette``.
+    """
+    return diffuse(pixels, None, palette)[0]
+
+
+def floyd_steinberg_bands(bands, palette=PALETTE, workers=1):
+    """Floyd-Steinberg error diffusion of an image fed in horizontal bands.
+
+    ``bands`` yields (rows, width, 3) RGB arrays from top to bottom. Yields a
+    (rows, width) index array for each band, identical to that part of
+    floyd_steinberg() on the whole image. Only two bands are held at a time.
+    With more than one worker, each band is split across processes as in
+    floyd_steinberg_parallel().
+    """
+    current = None
+    for band in bands:
+        band = np.array(band, dtype=np.float32)
+        if current is not None:
+            indices, carried = diffuse_parallel(current, band[0], palette, workers)
+            yield indices
+            # The first row has already picked up the error from above
+            band[0] = carried
+        current = band
+    if current is not None:
+        yield diffuse_parallel(current, None, palette, workers)[0]
+
+
+def diffuse(pixels, below, palette=PALETTE):
+    """Error-diffuse ``pixels`` into the row ``below`` it (None at the bottom).
+
+    Returns the (height, width) indices and the row below with this band's
+    error added, ready to be the first row of the next band.
+    """
+    height, width = pixels.shape[:2]
+    stride = width + 2
+
+    # One spare row below and one spare column on either side soak up the
+    # error that is pushed off the edges of the image. When there is a next
+    # band the spare row starts out as its first row, so it adds up the
+    # error in exactly the order a single pass would.
+    work = np.zeros((height + 1, stride, 3), dtype=np.float32)
+    work[:height, 1 : width + 1] = pixels
+    if below is not None:
+        work[height, 1 : width + 1] = below
+    work = work.reshape(-1, 3)
+    indices = np.zeros((height + 1) * stride, dtype=np.uint8)
+    diffuse_rows(work, indices, width, height, palette)
+
+    work = work.reshape(height + 1, stride, 3)
+    indices = indices.reshape(height + 1, stride)
+    return indices[:height, 1 : width + 1], work[height, 1 : width + 1]
+
+
+def diffuse_rows(work, indices, width, height, palette, wait=None, lut=None):
+    """Run the error diffusion wavefront over a padded, flattened buffer.
+
+    ``work`` is the (height + 1) * (width + 2) by 3 working image and
+    ``indices`` the matching palette index buffer, laid out as in diffuse().
+    If given, ``wait(t)`` is called before each step ``t``.
+    """
+    stride = width + 2
+    lut = lut or palette_lut(palette)
+
+    # Pixel (x, y) only depends on (x - 1, y) and on the row above up to
+    # (x + 1, y - 1), so every pixel on the line x + 2y = t can be quantized
+    # at once. In the flattened buffer those pixels are exactly `width`
+    # elements apart, which turns each step into a few strided slices.
+    for t in range(width + 2 * (height - 1)):
+        if wait:
+            wait(t)
+        y_min = max(0, (t - width + 2) // 2)
+        y_max = min(height - 1, t // 2)
+        start = y_min * stride + t - 2 * y_min + 1
+        span = (y_max - y_min) * width + 1
+
+        here = slice(start, start + span, width)
+        values = work[here]
+        index = lut.nearest(values)
+        indices[here] = index
+        error = values - palette[index]
+
+        # The row below is updated before the pixel to the right so that
+        # every pixel accumulates its error in the same order as a plain
+        # left-to-right, top-to-bottom scan would.
+        below = start + stride
+        work[below - 1 : below - 1 + span : width] += error * (3 / 16)
+        work[below : below + span : width] += error * (5 / 16)
+        work[below + 1 : below + 1 + span : width] += error * (1 / 16)
+        work[start + 1 : start + 1 + span : width] += error * (7 / 16)
+
+
+def floyd_steinberg_parallel(pixels, palette=PALETTE, workers=None):
+    """floyd_steinberg() split into horizontal bands run by worker processes.
+
+    The wavefront still has to take width + 2 * (height - 1) steps, but
+    each process only does the slice of every step that falls in its band,
+    so it pays off once a frame is large enough that the work in a step
+    outweighs the fixed cost of taking it. The result is bit-identical to
+    floyd_steinberg().
+    """
+    return diffuse_parallel(pixels, None, palette, workers)[0]
+
+
+def diffuse_parallel(pixels, below, palette=PALETTE, workers=None):
+    """diffuse() split into horizontal bands run by worker processes.
+
+    The workers are forked so that they share the buffers with no copying,
+    which is only safe while this is the process's only thread: any other
+    thread could hold a lock at the moment of the fork, and the children
+    would deadlock on it. With other threads running, such as the service's
+    ingest workers, this runs serially instead, with the same result.
+    """
+    height, width = pixels.shape[:2]
+    workers = min(workers or os.cpu_count() or 1, height // MIN_PARALLEL_BAND_ROWS)
+    if workers <= 1 or threading.active_count() > 1:
+        return diffuse(pixels, below, palette)
+
+    # Forked workers share these buffers with the parent and each other
+    context = multiprocessing.get_context("fork")
+    stride = width + 2
+    work_buffer = context.RawArray("f", (height + 1) * stride * 3)
+    index_buffer = context.RawArray("B", (height + 1) * stride)
+    work = np.frombuffer(work_buffer, dtype=np.float32).reshape(height + 1, stride, 3)
+    work[:height, 1 : width + 1] = pixels
+    if below is not None:
+        work[height, 1 : width + 1] = below
+    indices = np.frombuffer(index_buffer, dtype=np.uint8).reshape(height + 1, stride)
+    # Looked up once here rather than in every worker
+    lut = palette_lut(palette)
+
+    edges = [height * k // workers for k in range(workers + 1)]
+    progress = context.RawArray("q", workers)
+    condition = context.Condition()
+    processes = [
+        context.Process(
+            target=diffuse_band,
+            args=(work, indices, edges, k, palette, lut, progress, condition),
+            daemon=True,
+        )
+        for k in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        raise RuntimeError("A dither worker process failed.")
+
+    return (
+        indices[:height, 1 : width + 1].copy(),
+        work[height, 1 : width + 1].copy(),
+    )
+
+
+def diffuse_band(work, indices, edges, k, palette, lut, progress, condition):
+    """Diffuse band ``k`` of a shared buffer, staying behind band k - 1.
+
+    Band k's first row is the spare row of band k - 1, which adds error to
+    pixel (x, top) from (x - 1 .. x + 1, top - 1). A single pass would then
+    add the error from (x - 1, top) to its right. So before band k quantizes
+    (x, top) and pushes error into (x + 1, top), band k - 1 must have
+    finished (x + 2, top - 1).
+    """
+    top, bottom = edges[k], edges[k + 1]
+    height = bottom - top
+    width = work.shape[1] - 2
+    stride = width + 2
+    steps = width + 2 * (height - 1)
+    previous_rows = top - edges[k - 1] if k else 0
+    known_progress = 0
+
+    def publish(done):
+        with condition:
+            progress[k] = done
+            condition.notify_all()
+
+    def wait(t):
+        nonlocal known_progress
+        if t % PUBLISH_STEPS == 0:
+            publish(t)
+        if k == 0:
+            return
+        # Steps band k - 1 must have finished: its last row reaches column c
+        # after step c + 2 * (previous_rows - 1)
+        needed = min(t + 2, width - 1) + 2 * (previous_rows - 1) + 1
+        if known_progress < needed:
+            with condition:
+                condition.wait_for(lambda: progress[k - 1] >= needed)
+                known_progress = progress[k - 1]
+
+    try:
+        diffuse_rows(
+            work[top : bottom + 1].reshape(-1, 3),
+            indices[top : bottom + 1].reshape(-1),
+            width,
+            height,
+            palette,
+            wait,
+            lut,
+        )
+        publish(steps)
+    except BaseException:
+        # Don't leave the bands below waiting forever
+        publish(np.iinfo(np.int64).max)
+        raise
+
+
+# How far an ordered-dither threshold can push a channel either way. A full
+# step between black and white lets a gray ramp cover every mix of the two.
+ORDERED_SPREAD = 255.0
+
+
+@lru_cache(maxsize=None)
+def bayer_matrix(size=8):
+    """Return a (size, size) Bayer threshold map with values in (0, 1).
+
+    ``size`` must be a power of two.
+    """
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < size:
+        matrix = np.block(
+            [
+                [4 * matrix, 4 * matrix + 2],
+                [4 * matrix + 3, 4 * matrix + 1],
+            ]
+        )
+    return ((matrix + 0.5) / matrix.size).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def blue_noise_matrix(size=32, sigma=1.5, seed=0):
+    """Return a (size, size) blue-noise threshold map with values in (0, 1).
+
+    Built with Ulichney's void-and-cluster method from a fixed seed, so the
+    map (and everything dithered with it) is the same on every run. It takes
+    well under a second and is cached for the life of the process.
+    """
+    count = size * size
+    offsets = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma**2))
+
+    def energy_of(pattern):
+        # Toroidal Gaussian blur, so the map tiles without seams
+        return np.real(np.fft.ifft2(np.fft.fft2(pattern) * np.fft.fft2(kernel)))
+
+    def toggle(pattern, energy, i, value):
+        pattern.flat[i] = value
+        y, x = divmod(int(i), size)
+        energy += np.roll(kernel, (y, x), axis=(0, 1)) * (1 if value else -1)
+
+    def tightest_cluster(pattern, energy):
+        return np.where(pattern, energy, -np.inf).argmax()
+
+    def largest_void(pattern, energy):
+        return np.where(pattern, np.inf, energy).argmin()
+
+    # Start from a random pattern with a tenth of the pixels set, then move
+    # points from the tightest cluster to the largest void until it settles.
+    rng = np.random.default_rng(seed)
+    prototype = np.zeros((size, size), dtype=bool)
+    prototype.flat[rng.choice(count, count // 10, replace=False)] = True
+    energy = energy_of(prototype)
+    while True:
+        cluster = tightest_cluster(prototype, energy)
+        toggle(prototype, energy, cluster, False)
+        void = largest_void(prototype, energy)
+        if void == cluster:
+            toggle(prototype, energy, cluster, True)
+            break
+        toggle(prototype, energy, void, True)
+
+    ranks = np.zeros(count, dtype=np.int64)
+    ones = int(prototype.sum())
+
+    # Ranks below the prototype: remove the tightest cluster each time
+    pattern = prototype.copy()
+    energy = energy_of(pattern)
+    for rank in range(ones - 1, -1, -1):
+        cluster = tightest_cluster(pattern, energy)
+        toggle(pattern, energy, cluster, False)
+        ranks[cluster] = rank
+
+    # Ranks above it: fill the largest void each time
+    pattern = prototype.copy()
+    energy = energy_of(pattern)
+    for rank in range(ones, count):
+        void = largest_void(pattern, energy)
+        toggle(pattern, energy, void, True)
+        ranks[void] = rank
+
+    return ((ranks.reshape(size, size) + 0.5) / count).astype(np.float32)
+
+
+def ordered_dither(
+    pixels, thresholds, palette=PALETTE, spread=ORDERED_SPREAD, first_row=0
+):
+    """Ordered dithering of an (height, width, 3) RGB array.
+
+    ``thresholds`` is a threshold map such as bayer_matrix() or
+    blue_noise_matrix(), tiled over the image. Every pixel is quantized on
+    its own, so the whole image is done in one vectorized pass and the result
+    depends only on the input. For a band of a larger image, ``first_row``
+    is the image row the band starts at, which keeps the tiling aligned.
+
+    Returns a (height, width) uint8 array of indices into ``palette``.
+    """
+    height, width = pixels.shape[:2]
+    rows, cols = thresholds.shape
+    thresholds = np.roll(thresholds, -(first_row % rows), axis=0)
+    tiled = np.tile(thresholds, (-(-height // rows), -(-width // cols)))
+    offsets = (tiled[:height, :width] - 0.5) * spread
+
+    values = pixels.reshape(-1, 3) + offsets.reshape(-1, 1)
+    return palette_lut(palette).nearest(values).reshape(height, width)
+
+
+def pack_plane(ink):
+    """Pack a boolean (height, width) ink mask into raw PIL mode "1" bytes.
+
+    Inked pixels become 0 (black) and everything else 1 (white), which is
+    what the display code expects to find in the saved plane bitmaps.
+    """
+    return np.packbits(~ink, axis=1).tobytes()
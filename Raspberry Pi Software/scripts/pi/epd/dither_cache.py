@@ -0,0 +1,100 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+# When the cache outgrows its quota, the least recently used entries are
+# removed until it's back down to this fraction of it, so eviction doesn't
+# run again on the very next insert.
+EVICT_TO_FRACTION = 0.9
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        file_hash = hashlib.sha256()
+        while chunk := f.read(65536):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class DitherCache:
+    """Content-addressed cache of processed frames with LRU eviction.
+
+    Entries are frame files (see frame.py) named by a key that covers the
+    original's hash and everything about the pipeline that affects the
+    output, so a stale entry can never be returned: changing the pipeline
+    just stops its old entries from being used, and they age out.
+
+    Recency is the file's mtime, which get() refreshes, so several processes
+    can share one cache directory.
+    """
+
+    def __init__(self, root, quota_bytes):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.lock = Lock()
+        # Bytes in the cache as of the last scan plus what this process has
+        # added since. None until the first put().
+        self.size = None
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.epd")
+
+    def get(self, key):
+        """Return the path of the cached frame for key, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, frame_path):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as dst, open(frame_path, "rb") as src:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            if self.size is None:
+                self.size = self._scan_size()
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.quota_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".epd"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Rescan rather than trust self.size; other processes add entries too
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.quota_bytes * EVICT_TO_FRACTION
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
@@ -3,9 +3,12 @@ import os
 import urllib.request
 from process_image import process_image
 from update_display import update_display
+from ingest_workspace import IngestWorkspace
 
 
 def download_image(url, download_folder):
+    # Give each ingest its own download_folder (see IngestWorkspace);
+    # the file name here is fixed.
     local_filename = os.path.join(download_folder, "temp_downloaded_image.jpg")
     urllib.request.urlretrieve(url, local_filename)
     return local_filename
@@ -21,37 +24,42 @@ def main():
     download_folder = "/mnt/sda2/tmp"
     image_folder = "/mnt/sda2/images"
 
-    downloaded_image_path = None
-
     try:
-        downloaded_image_path = download_image(image_url, download_folder)
-        print(f"Downloaded image to {downloaded_image_path}")
+        # Everything is written inside the workspace and only moved into
+        # image_folder once it's complete. A failure removes the workspace,
+        # and with it any outputs already moved.
+        with IngestWorkspace(download_folder) as workspace:
+            downloaded_image_path = download_image(image_url, workspace.path)
+            print(f"Downloaded image to {downloaded_image_path}")
+
+            # Process the image
+            result = process_image(
+                downloaded_image_path, workspace.path, custom_filename
+            )
 
-        # Process the image
-        black_image_path, red_image_path = process_image(
-            downloaded_image_path, image_folder, custom_filename
-        )
+            if not result:
+                raise Exception("Image processing failed.")
 
-        if not black_image_path or not red_image_path:
-            raise Exception("Image processing failed.")
+            black_image_path, red_image_path, frame_path = (
+                workspace.commit(
+                    path, os.path.join(image_folder, os.path.basename(path))
+                )
+                for path in result
+            )
 
         # Print both paths
         print(f"Black image path: {black_image_path}")
         print(f"Red image path: {red_image_path}")
+        print(f"Frame path: {frame_path}")
 
         # Update the EPD
-        update_display(black_image_path, red_image_path)
+        update_display(black_image_path, red_image_path, frame_path)
         print("Updated the ePaper display.")
 
     except Exception as e:
         print(f"An error occurred: {e}")
         sys.exit(1)
 
-    finally:
-        if downloaded_image_path and os.path.exists(downloaded_image_path):
-            os.remove(downloaded_image_path)
-            print(f"Deleted temporary image at {downloaded_image_path}")
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+import os
+import struct
+
+# A frame file holds the exact bytes the 7.5" panel expects for a refresh:
+#
+#   header: magic, format version, width, height
+#   black plane: sent with command 0x10 (1 = white, 0 = black)
+#   red plane: sent with command 0x13 (1 = red, 0 = no ink)
+#
+# so a display update can push it over SPI without decoding any images.
+FRAME_MAGIC = b"MBXF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBxHH")
+
+# Flips every bit of a byte when used with bytes.translate().
+INVERT_TABLE = bytes(0xFF - i for i in range(256))
+
+
+class FrameError(Exception):
+    pass
+
+
+def plane_size(width, height):
+    return (width + 7) // 8 * height
+
+
+def write_frame(path, black_image, red_image):
+    """Write the panel-ready frame for a pair of black and red plane images."""
+    width, height = black_image.size
+    if red_image.size != (width, height):
+        raise FrameError("Black and red planes must be the same size.")
+
+    # In PIL's mode "1" a set bit is white. The black plane is sent as-is,
+    # while the red plane has to be inverted so that a set bit means red ink.
+    black = black_image.convert("1").tobytes("raw")
+    red = red_image.convert("1").tobytes("raw").translate(INVERT_TABLE)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, width, height))
+        f.write(black)
+        f.write(red)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_frame(path):
+    """Return (width, height, black_plane, red_plane) from a frame file."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < FRAME_HEADER.size:
+        raise FrameError(f"Frame file '{path}' is truncated.")
+    magic, version, width, height = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise FrameError(f"'{path}' is not a version {FRAME_VERSION} frame file.")
+
+    size = plane_size(width, height)
+    if len(data) != FRAME_HEADER.size + 2 * size:
+        raise FrameError(f"Frame file '{path}' has the wrong length.")
+
+    black_start = FRAME_HEADER.size
+    red_start = black_start + size
+    return width, height, data[black_start:red_start], data[red_start:]
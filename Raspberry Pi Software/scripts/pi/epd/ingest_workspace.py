@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+
+class IngestWorkspace:
+    """Private scratch directory for a single ingest.
+
+    Everything an ingest writes before it is stored lives in its own
+    directory, so ingests running in parallel can't overwrite each other's
+    files. commit() moves a finished file into place with an atomic rename.
+    Leaving the `with` block removes the directory, and if the block raised,
+    also removes the files it had already committed.
+    """
+
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="ingest-", dir=root)
+        self.committed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.rollback()
+        self.cleanup()
+        return False
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def commit(self, src, dest):
+        # The workspace root must be on the same filesystem as `dest` for the
+        # rename to be atomic; /mnt/sda2/tmp and /mnt/sda2/images both are.
+        os.replace(src, dest)
+        self.committed.append(dest)
+        return dest
+
+    def rollback(self):
+        for path in self.committed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.committed = []
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
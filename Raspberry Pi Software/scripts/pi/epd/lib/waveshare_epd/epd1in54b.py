@@ -29,6 +29,7 @@
 
 import logging
 from . import epdconfig
+from . import packing
 
 # Display resolution
 EPD_WIDTH       = 200
@@ -146,22 +147,11 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        buf = [0xFF] * int(self.width * self.height / 8)
-        # Set buffer to value of Python Imaging Library image.
-        # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        if imwidth != self.width or imheight != self.height:
+        # Image must be the same size as the display; it isn't rotated.
+        if image.size != (self.width, self.height):
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).' .format(self.width, self.height))
-
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] == 0:
-                    buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        return buf
+        return packing.pack_1bit(image, self.width, self.height)
 
     def display(self, blackimage, redimage):
         # send black data
@@ -30,6 +30,9 @@
 
 import logging
 from . import epdconfig
+from . import packing
+
+from PIL import Image
 
 # Display resolution
 EPD_WIDTH       = 122
@@ -219,35 +222,18 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
+        linewidth = (self.width + 7) // 8
         image_monocolor = image.convert('1')
         imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
         if(imwidth == self.width and imheight == self.height):
             logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+            # Rows go out mirrored, starting one bit in
+            return packing.pack_rows(image_monocolor.transpose(Image.FLIP_LEFT_RIGHT), linewidth, 1)
         elif(imwidth == self.height and imheight == self.width):
             logger.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
-        
-        
+            return packing.pack_rows(image_monocolor.transpose(Image.TRANSPOSE), linewidth)
+        return bytearray([0xFF]) * (linewidth * self.height)
+
     def display(self, image):
         self.send_command(0x24)
         self.send_data2(image)   
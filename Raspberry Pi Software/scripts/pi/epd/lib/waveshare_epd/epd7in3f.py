@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import packing
 
 import PIL
 from PIL import Image
@@ -39,9 +40,35 @@ import io
 EPD_WIDTH       = 800
 EPD_HEIGHT      = 480
 
+# Register setup sent by init() after the reset, as (command, data) pairs
+INIT_SETTINGS = (
+    (0xAA, b'\x49\x55\x20\x08\x09\x18'),  # CMDH
+    (0x01, b'\x3f\x00\x32\x2a\x0e\x2a'),
+    (0x00, b'\x5f\x69'),
+    (0x03, b'\x00\x54\x00\x44'),
+    (0x05, b'\x40\x1f\x1f\x2c'),
+    (0x06, b'\x6f\x1f\x1f\x22'),
+    (0x08, b'\x6f\x1f\x1f\x22'),
+    (0x13, b'\x00\x04'),            # IPC
+    (0x30, b'\x3c'),
+    (0x41, b'\x00'),                # TSE
+    (0x50, b'\x3f'),
+    (0x60, b'\x02\x00'),
+    (0x61, b'\x03\x20\x01\xe0'),
+    (0x82, b'\x1e'),
+    (0x84, b'\x00'),
+    (0x86, b'\x00'),                # AGID
+    (0xE3, b'\x2f'),
+    (0xE0, b'\x00'),                # CCSET
+    (0xE6, b'\x00'),                # TSSET
+)
+
+# Colours the panel shows, in the order of their 4-bit codes
+PALETTE = ((0, 0, 0), (255, 255, 255), (0, 255, 0), (0, 0, 255), (255, 0, 0), (255, 255, 0), (255, 128, 0))
+
 logger = logging.getLogger(__name__)
 
-class EPD:
+class EPD(epdconfig.Transactions):
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
         self.dc_pin = epdconfig.DC_PIN
@@ -84,7 +111,7 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
-        
+
     def ReadBusyH(self):
         logger.debug("e-Paper busy H")
         while(epdconfig.digital_read(self.busy_pin) == 0):      # 0: busy, 1: idle
@@ -95,12 +122,10 @@ class EPD:
         self.send_command(0x04) # POWER_ON
         self.ReadBusyH()
 
-        self.send_command(0x12) # DISPLAY_REFRESH
-        self.send_data(0X00)
+        self.send_transaction(0x12, b'\x00') # DISPLAY_REFRESH
         self.ReadBusyH()
         
-        self.send_command(0x02) # POWER_OFF
-        self.send_data(0X00)
+        self.send_transaction(0x02, b'\x00') # POWER_OFF
         self.ReadBusyH()
         
     def init(self):
@@ -111,135 +136,26 @@ class EPD:
         self.ReadBusyH()
         epdconfig.delay_ms(30)
 
-        self.send_command(0xAA)    # CMDH
-        self.send_data(0x49)
-        self.send_data(0x55)
-        self.send_data(0x20)
-        self.send_data(0x08)
-        self.send_data(0x09)
-        self.send_data(0x18)
-
-        self.send_command(0x01)
-        self.send_data(0x3F)
-        self.send_data(0x00)
-        self.send_data(0x32)
-        self.send_data(0x2A)
-        self.send_data(0x0E)
-        self.send_data(0x2A)
-
-        self.send_command(0x00)
-        self.send_data(0x5F)
-        self.send_data(0x69)
-
-        self.send_command(0x03)
-        self.send_data(0x00)
-        self.send_data(0x54)
-        self.send_data(0x00)
-        self.send_data(0x44) 
-
-        self.send_command(0x05)
-        self.send_data(0x40)
-        self.send_data(0x1F)
-        self.send_data(0x1F)
-        self.send_data(0x2C)
-
-        self.send_command(0x06)
-        self.send_data(0x6F)
-        self.send_data(0x1F)
-        self.send_data(0x1F)
-        self.send_data(0x22)
-
-        self.send_command(0x08)
-        self.send_data(0x6F)
-        self.send_data(0x1F)
-        self.send_data(0x1F)
-        self.send_data(0x22)
-
-        self.send_command(0x13)    # IPC
-        self.send_data(0x00)
-        self.send_data(0x04)
-
-        self.send_command(0x30)
-        self.send_data(0x3C)
-
-        self.send_command(0x41)     # TSE
-        self.send_data(0x00)
-
-        self.send_command(0x50)
-        self.send_data(0x3F)
-
-        self.send_command(0x60)
-        self.send_data(0x02)
-        self.send_data(0x00)
-
-        self.send_command(0x61)
-        self.send_data(0x03)
-        self.send_data(0x20)
-        self.send_data(0x01) 
-        self.send_data(0xE0)
-
-        self.send_command(0x82)
-        self.send_data(0x1E) 
-
-        self.send_command(0x84)
-        self.send_data(0x00)
-
-        self.send_command(0x86)    # AGID
-        self.send_data(0x00)
-
-        self.send_command(0xE3)
-        self.send_data(0x2F)
-
-        self.send_command(0xE0)   # CCSET
-        self.send_data(0x00) 
-
-        self.send_command(0xE6)   # TSSET
-        self.send_data(0x00)
+        self.send_table(INIT_SETTINGS)
         return 0
 
     def getbuffer(self, image):
-        # Create a pallette with the 7 colors supported by the panel
-        pal_image = Image.new("P", (1,1))
-        pal_image.putpalette( (0,0,0,  255,255,255,  0,255,0,   0,0,255,  255,0,0,  255,255,0, 255,128,0) + (0,0,0)*249)
-
-        # Check if we need to rotate the image
-        imwidth, imheight = image.size
-        if(imwidth == self.width and imheight == self.height):
-            image_temp = image
-        elif(imwidth == self.height and imheight == self.width):
-            image_temp = image.rotate(90, expand=True)
-        else:
-            logger.warning("Invalid image dimensions: %d x %d, expected %d x %d" % (imwidth, imheight, self.width, self.height))
-
-        # Convert the soruce image to the 7 colors, dithering if needed
-        image_7color = image_temp.convert("RGB").quantize(palette=pal_image)
-        buf_7color = bytearray(image_7color.tobytes('raw'))
-
-        # PIL does not support 4 bit color, so pack the 4 bits of color
-        # into a single byte to transfer to the panel
-        buf = [0x00] * int(self.width * self.height / 2)
-        idx = 0
-        for i in range(0, len(buf_7color), 2):
-            buf[idx] = (buf_7color[i] << 4) + buf_7color[i+1]
-            idx += 1
-            
-        return buf
+        # Quantize to the panel's colours, dithering if needed, and pack
+        # 2 pixels into each byte
+        return packing.pack_palette(image, self.width, self.height, PALETTE, 4)
 
     def display(self, image):
-        self.send_command(0x10)
-        self.send_data2(image)
+        self.send_transaction(0x10, image)
 
         self.TurnOnDisplay()
         
     def Clear(self, color=0x11):
-        self.send_command(0x10)
-        self.send_data2([color] * int(self.height) * int(self.width/2))
+        self.send_transaction(0x10, bytes([color]) * (int(self.height) * int(self.width/2)))
 
         self.TurnOnDisplay()
 
     def sleep(self):
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_transaction(0x07, b'\xa5') # DEEP_SLEEP
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
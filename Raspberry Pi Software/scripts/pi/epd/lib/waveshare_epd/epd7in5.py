@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import packing
 
 # Display resolution
 EPD_WIDTH       = 640
@@ -127,8 +128,6 @@ class EPD:
     def getbuffer(self, image):
         img = image
         imwidth, imheight = img.size
-        halfwidth = int(self.width / 2)
-        buf = [0x33] * halfwidth * self.height
         
         if(imwidth == self.width and imheight == self.height):
             img = img.convert('1')
@@ -138,25 +137,10 @@ class EPD:
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return buf
+            return bytearray([0x33]) * (self.width // 2 * self.height)
         
-        pixels = img.load()
-
-        for y in range(imheight):
-            offset = y * halfwidth
-            for x in range(1, imwidth, 2):
-                i = offset + x // 2
-                if(pixels[x-1, y] > 191):
-                    if(pixels[x, y] > 191):
-                        buf[i] = 0x33
-                    else:
-                        buf[i] = 0x30
-                else:
-                    if(pixels[x, y] > 191):
-                        buf[i] = 0x03
-                    else:
-                        buf[i] = 0x00
-        return buf
+        # Two pixels to a byte, 0x3 for white and 0x0 for black
+        return packing.pack_indices(img.convert('L').point(lambda p: 3 if p > 191 else 0), 4)
         
     def display(self, image):
         self.send_command(0x10)
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import packing
 
 # Display resolution
 EPD_WIDTH       = 800
@@ -140,12 +141,9 @@ class EPD:
             # return a blank buffer
             return [0x00] * (int(self.width/8) * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
         # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        return packing.invert(img.tobytes('raw'))
 
     def display(self, image):
         self.send_command(0x13)
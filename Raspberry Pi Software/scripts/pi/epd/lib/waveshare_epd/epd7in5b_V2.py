@@ -35,16 +35,45 @@ from . import epdconfig
 EPD_WIDTH       = 800
 EPD_HEIGHT      = 480
 
+# A three-color refresh normally keeps BUSY low for 15-20 s
+BUSY_TIMEOUT_MS = 60000
+# Longest single edge wait, in case an edge is missed between the read and the wait
+BUSY_EDGE_WAIT_MS = 250
+# Polling fallback backs off from 1 ms up to this interval
+BUSY_POLL_MAX_MS = 100
+
+# bytes.translate() table that flips every bit of a byte
+INVERT_TABLE = bytes(0xFF - i for i in range(256))
+
+# Register setup done by wake(), as (command, data) pairs sent in one
+# transaction each side of POWER ON
+POWER_SETTINGS = (
+    (0x01, b'\x07\x07\x3f\x3f'),  # POWER SETTING: VGH=20V,VGL=-20V,VDH=15V,VDL=-15V
+)
+# (0x06, b'\x17\x17\x38\x17') is booster soft start (btst); if an exception
+# is displayed, try adding it to POWER_SETTINGS with 0x38 as the third byte.
+
+PANEL_SETTINGS = (
+    (0x00, b'\x0f'),              # PANNEL SETTING: KW-3f KWR-2F BWROTP-0f BWOTP-1f
+    (0x61, b'\x03\x20\x01\xe0'),  # tres: source 800, gate 480
+    (0x15, b'\x00'),
+    (0x50, b'\x11\x07'),          # VCOM AND DATA INTERVAL SETTING
+    (0x60, b'\x22'),              # TCON SETTING
+    (0x65, b'\x00\x00\x00\x00'),
+)
+
 logger = logging.getLogger(__name__)
 
-class EPD:
-    def __init__(self):
+class EPD(epdconfig.Transactions):
+    def __init__(self, busy_timeout_ms=BUSY_TIMEOUT_MS):
         self.reset_pin = epdconfig.RST_PIN
         self.dc_pin = epdconfig.DC_PIN
         self.busy_pin = epdconfig.BUSY_PIN
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.busy_timeout_ms = busy_timeout_ms
+        self.use_edge_wait = True
 
     # Hardware reset
     def reset(self):
@@ -75,9 +104,35 @@ class EPD:
 
     def ReadBusy(self):
         logger.debug("e-Paper busy")
+        # The timeout counts the waits asked of epdconfig rather than the
+        # wall clock, so the virtual backend gives up in simulated time
+        waited_ms = 0
+        poll_ms = 1
         self.send_command(0x71)
         busy = epdconfig.digital_read(self.busy_pin)
         while(busy == 0):
+            remaining_ms = self.busy_timeout_ms - waited_ms
+            if remaining_ms <= 0:
+                # Don't leave the panel driving its high voltages indefinitely
+                logger.error("e-Paper still busy after %d ms, resetting", self.busy_timeout_ms)
+                self.reset()
+                raise TimeoutError("e-Paper busy timeout")
+
+            if self.use_edge_wait:
+                # BUSY goes high when the panel is done
+                wait_ms = min(remaining_ms, BUSY_EDGE_WAIT_MS)
+                try:
+                    epdconfig.wait_for_edge(self.busy_pin, True, wait_ms)
+                except RuntimeError as e:
+                    logger.warning("Edge detection unavailable (%s), polling BUSY instead", e)
+                    self.use_edge_wait = False
+                    wait_ms = 0
+            else:
+                wait_ms = min(poll_ms, remaining_ms)
+                epdconfig.delay_ms(wait_ms)
+                poll_ms = min(poll_ms * 2, BUSY_POLL_MAX_MS)
+            waited_ms += wait_ms
+
             self.send_command(0x71)
             busy = epdconfig.digital_read(self.busy_pin)
         epdconfig.delay_ms(200)
@@ -86,53 +141,21 @@ class EPD:
     def init(self):
         if (epdconfig.module_init() != 0):
             return -1
-            
-        self.reset()
-        
-        # self.send_command(0x06)   # btst
-        # self.send_data(0x17)
-        # self.send_data(0x17)
-        # self.send_data(0x38)      # If an exception is displayed, try using 0x38
-        # self.send_data(0x17)
-
-        self.send_command(0x01)     # POWER SETTING
-        self.send_data(0x07)
-        self.send_data(0x07)        # VGH=20V,VGL=-20V
-        self.send_data(0x3f)        # VDH=15V
-        self.send_data(0x3f)        # VDL=-15V
-
-        self.send_command(0x04)     # POWER ON
-        epdconfig.delay_ms(100)
-        self.ReadBusy()
 
-        self.send_command(0X00)     # PANNEL SETTING
-        self.send_data(0x0F)        # KW-3f KWR-2F BWROTP-0f BWOTP-1f
+        return self.wake()
 
-        self.send_command(0x61)     # tres
-        self.send_data(0x03)        # source 800
-        self.send_data(0x20)
-        self.send_data(0x01)        # gate 480
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        self.send_command(0X50)     # VCOM AND DATA INTERVAL SETTING
-        self.send_data(0x11)
-        self.send_data(0x07)
-
-        self.send_command(0X60)     # TCON SETTING
-        self.send_data(0x22)
+    # Reset and register setup, without touching the SPI/GPIO handles.
+    # Needed after deep sleep, which loses the register contents.
+    def wake(self):
+        self.reset()
 
-        self.send_command(0x65)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-        self.send_data(0x00)
-    
+        self.send_table(POWER_SETTINGS)
+        self.power_on()
+        self.send_table(PANEL_SETTINGS)
         return 0
 
-    def getbuffer(self, image):
+    def _pack(self, image):
+        # The image packed in PIL polarity (1=white), or None if it's the wrong size
         img = image
         imwidth, imheight = img.size
         if(imwidth == self.width and imheight == self.height):
@@ -142,49 +165,65 @@ class EPD:
             img = img.rotate(90, expand=True).convert('1')
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
+            return None
+        return img.tobytes('raw')
+
+    def getbuffer(self, image):
+        buf = self._pack(image)
+        if buf is None:
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            return bytes(int(self.width/8) * self.height)
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
         # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
+        return buf.translate(INVERT_TABLE)
+
+    def getbuffer_black(self, image):
+        # The black plane in panel polarity, ready for display_frame(). This is
+        # getbuffer() inverted back, without inverting it twice.
+        buf = self._pack(image)
+        if buf is None:
+            return b'\xff' * (int(self.width/8) * self.height)
         return buf
 
     def display(self, imageblack, imagered):
-        self.send_command(0x10)
-        # The black bytes need to be inverted back from what getbuffer did
-        for i in range(len(imageblack)):
-            imageblack[i] ^= 0xFF
-        self.send_data2(imageblack)
-
-        self.send_command(0x13)
-        self.send_data2(imagered)
-        
-        self.send_command(0x12)
+        # The black bytes need to be inverted back from what getbuffer did.
+        # This makes a new buffer, so the caller's copy is left untouched.
+        # Callers that build the planes themselves should use getbuffer_black()
+        # and display_frame(), which skip both inversions.
+        self.display_frame(bytes(imageblack).translate(INVERT_TABLE), imagered)
+
+    def display_frame(self, imageblack, imagered):
+        # Both planes are already in panel polarity (see frame.py), so they
+        # go out exactly as stored.
+        self.send_table(((0x10, imageblack), (0x13, imagered), (0x12, None)))
         epdconfig.delay_ms(100)
         self.ReadBusy()
         
     def Clear(self):
-        buf = [0x00] * (int(self.width/8) * self.height)
-        buf2 = [0xff] * (int(self.width/8) * self.height)
-        self.send_command(0x10)
-        self.send_data2(buf2)
-            
-        self.send_command(0x13)
-        self.send_data2(buf)
-                
-        self.send_command(0x12)
+        buf = bytes(int(self.width/8) * self.height)
+        buf2 = b'\xff' * (int(self.width/8) * self.height)
+        self.send_table(((0x10, buf2), (0x13, buf), (0x12, None)))
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def sleep(self):
+    def power_on(self):
+        self.send_command(0x04) # POWER ON
+        epdconfig.delay_ms(100)
+        self.ReadBusy()
+
+    # Registers survive a power off, so power_on() alone brings the panel back
+    def power_off(self):
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
-        
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+
+    # Only a hardware reset (see wake()) leaves deep sleep
+    def deep_sleep(self):
+        self.send_transaction(0x07, b'\xa5') # DEEP_SLEEP
+
+    def sleep(self):
+        self.power_off()
+        self.deep_sleep()
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
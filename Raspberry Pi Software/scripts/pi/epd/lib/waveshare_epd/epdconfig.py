@@ -59,6 +59,11 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, rising, timeout_ms):
+        # Blocks in the kernel instead of polling. Returns False on timeout.
+        edge = self.GPIO.RISING if rising else self.GPIO.FALLING
+        return self.GPIO.wait_for_edge(pin, edge, timeout=max(1, int(timeout_ms))) is not None
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
@@ -130,6 +135,10 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, rising, timeout_ms):
+        edge = self.GPIO.RISING if rising else self.GPIO.FALLING
+        return self.GPIO.wait_for_edge(self.BUSY_PIN, edge, timeout=max(1, int(timeout_ms))) is not None
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
@@ -188,6 +197,10 @@ class SunriseX3:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, rising, timeout_ms):
+        edge = self.GPIO.RISING if rising else self.GPIO.FALLING
+        return self.GPIO.wait_for_edge(pin, edge, timeout=max(1, int(timeout_ms))) is not None
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
@@ -230,7 +243,207 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
+class Virtual:
+    """Stands in for the panel's SPI and GPIO when there's no hardware.
+
+    Decodes the command/data stream of the epd7in5b_V2 controller, keeps
+    the planes it is sent and renders them at each refresh (0x12), writing
+    a PNG per refresh when MEMORYBOX_EPD_VIRTUAL_DIR is set. Time is
+    simulated: delays, SPI transfers and BUSY waits advance a virtual clock
+    instead of sleeping, and BUSY is held low for as long as BUSY_MS says
+    the command would take on a real panel. stats() returns the counters
+    and last_frame() the image shown by the last refresh.
+    """
+
+    # Pin definition
+    RST_PIN  = 17
+    DC_PIN   = 25
+    CS_PIN   = 8
+    BUSY_PIN = 24
+    PWR_PIN  = 18
+
+    # Timing model, in line with a Raspberry Pi driving the 7.5" panel.
+    # Transfers are clocked at SPI_HZ plus a fixed cost per transfer call,
+    # and each GPIO write costs GPIO_WRITE_US.
+    SPI_HZ = 4000000
+    SPI_TRANSFER_US = 15
+    GPIO_WRITE_US = 2
+    # How long BUSY stays low after each command
+    BUSY_MS = {
+        0x02: 30,     # POWER OFF
+        0x04: 60,     # POWER ON
+        0x12: 16000,  # DISPLAY REFRESH (three-colour waveform)
+    }
+
+    # Commands whose data is a plane: 0x10 is black (1 = white), 0x13 red (1 = red)
+    PLANE_COMMANDS = (0x10, 0x13)
+    RESOLUTION_COMMAND = 0x61
+    DEEP_SLEEP_COMMAND = 0x07
+
+    def __init__(self):
+        self._output_dir = os.environ.get('MEMORYBOX_EPD_VIRTUAL_DIR', '')
+        self._pins = {}
+        self._width = 800
+        self._height = 480
+        self._planes = {}
+        self._command = None
+        self._data = bytearray()
+        self._busy_until_ms = 0.0
+        self._asleep = False
+        self._frame = None
+        self._frames_saved = 0
+        self._clock_ms = 0.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._stats_start_ms = self._clock_ms
+        self._busy_ms = 0.0
+        self._spi_bytes = 0
+        self._spi_transfers = 0
+        self._gpio_writes = 0
+        self._gpio_toggles = 0
+        self._commands = {}
+        self._refreshes = 0
+
+    def stats(self):
+        return {
+            'elapsed_ms': self._clock_ms - self._stats_start_ms,
+            'busy_ms': self._busy_ms,
+            'spi_bytes': self._spi_bytes,
+            'spi_transfers': self._spi_transfers,
+            'gpio_writes': self._gpio_writes,
+            'gpio_toggles': self._gpio_toggles,
+            'commands': dict(self._commands),
+            'refreshes': self._refreshes,
+        }
+
+    def last_frame(self):
+        """The RGB image shown by the last refresh, or None."""
+        return self._frame
+
+    def digital_write(self, pin, value):
+        self._clock_ms += self.GPIO_WRITE_US / 1000.0
+        self._gpio_writes += 1
+        previous = self._pins.get(pin)
+        if previous is not None and previous != value:
+            self._gpio_toggles += 1
+        self._pins[pin] = value
+
+        # The controller leaves deep sleep on a hardware reset
+        if pin == self.RST_PIN and value == 0:
+            self._end_command()
+            self._command = None
+            self._asleep = False
+            self._busy_until_ms = self._clock_ms
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            # Low while busy. In deep sleep the panel doesn't answer at all.
+            return 0 if self._asleep or self._clock_ms < self._busy_until_ms else 1
+        return self._pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._clock_ms += delaytime
+
+    def wait_for_edge(self, pin, rising, timeout_ms):
+        timeout_at = self._clock_ms + max(1, int(timeout_ms))
+        if pin == self.BUSY_PIN and rising and not self._asleep and self._busy_until_ms <= timeout_at:
+            self._clock_ms = max(self._clock_ms, self._busy_until_ms)
+            return True
+        self._clock_ms = timeout_at
+        return False
+
+    def spi_writebyte(self, data):
+        self._transfer(data)
+
+    def spi_writebyte2(self, data):
+        self._transfer(data)
+
+    def _transfer(self, data):
+        data = bytes(data)
+        self._spi_transfers += 1
+        self._spi_bytes += len(data)
+        self._clock_ms += (self.SPI_TRANSFER_US + len(data) * 8 * 1e6 / self.SPI_HZ) / 1000.0
+        if self._pins.get(self.CS_PIN, 1) != 0 or self._asleep:
+            return
+
+        if self._pins.get(self.DC_PIN, 0) == 0:
+            for command in data:
+                self._start_command(command)
+        else:
+            self._data += data
+            if self._command == self.DEEP_SLEEP_COMMAND and self._data[:1] == b'\xa5':
+                self._asleep = True
+
+    def _start_command(self, command):
+        self._end_command()
+        self._command = command
+        self._commands[command] = self._commands.get(command, 0) + 1
+
+        busy_ms = self.BUSY_MS.get(command)
+        if busy_ms:
+            self._busy_until_ms = max(self._busy_until_ms, self._clock_ms) + busy_ms
+            self._busy_ms += busy_ms
+        if command == 0x12:
+            self._refresh()
+
+    def _end_command(self):
+        # Data belongs to the last command sent, so a command's data is
+        # complete once the next command starts
+        command, data = self._command, bytes(self._data)
+        self._data = bytearray()
+        if command in self.PLANE_COMMANDS:
+            self._planes[command] = data
+        elif command == self.RESOLUTION_COMMAND and len(data) >= 4:
+            self._width = (data[0] << 8) | data[1]
+            self._height = (data[2] << 8) | data[3]
+
+    def _refresh(self):
+        from PIL import Image
+
+        size = (self._width, self._height)
+        plane_size = (self._width + 7) // 8 * self._height
+        black = self._planes.get(0x10, b'')[:plane_size].ljust(plane_size, b'\xff')
+        red = self._planes.get(0x13, b'')[:plane_size].ljust(plane_size, b'\x00')
+
+        frame = Image.frombytes('1', size, black).convert('RGB')
+        frame.paste((255, 0, 0), mask=Image.frombytes('1', size, red))
+        self._frame = frame
+        self._refreshes += 1
+
+        if self._output_dir:
+            self._frames_saved += 1
+            os.makedirs(self._output_dir, exist_ok=True)
+            path = os.path.join(self._output_dir, 'refresh-%04d.png' % self._frames_saved)
+            frame.save(path)
+            logger.debug("Virtual panel refresh saved to %s", path)
+
+    def module_init(self):
+        self.digital_write(self.PWR_PIN, 1)
+        return 0
+
+    def module_exit(self):
+        logger.debug("close 5V, Module enters 0 power consumption ...")
+        self.digital_write(self.RST_PIN, 0)
+        self.digital_write(self.DC_PIN, 0)
+        self.digital_write(self.PWR_PIN, 0)
+
+
+# MEMORYBOX_EPD_BACKEND picks the backend by name, "virtual" included;
+# otherwise it's worked out from the platform drivers present
+IMPLEMENTATIONS = {
+    'raspberrypi': RaspberryPi,
+    'sunrisex3': SunriseX3,
+    'jetsonnano': JetsonNano,
+    'virtual': Virtual,
+}
+backend = os.environ.get('MEMORYBOX_EPD_BACKEND', '').lower()
+
+if backend:
+    if backend not in IMPLEMENTATIONS:
+        raise RuntimeError("Unknown EPD backend '%s'" % backend)
+    implementation = IMPLEMENTATIONS[backend]()
+elif os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
     implementation = RaspberryPi()
 elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
     implementation = SunriseX3()
@@ -240,4 +453,35 @@ else:
 for func in [x for x in dir(implementation) if not x.startswith('_')]:
     setattr(sys.modules[__name__], func, getattr(implementation, func))
 
+
+def send_transactions(dc_pin, cs_pin, transactions):
+    """Send (command, data) pairs with CS held low across all of them.
+
+    Each command byte goes out with DC low and its data with DC high, one
+    transfer each, so writing a register costs two transfers and two GPIO
+    writes however many data bytes it takes, rather than a transfer and
+    three GPIO writes per byte. The controller samples DC on every byte, so
+    CS doesn't need to go high in between.
+    """
+    digital_write(cs_pin, 0)
+    for command, data in transactions:
+        digital_write(dc_pin, 0)
+        spi_writebyte([command])
+        if data:
+            digital_write(dc_pin, 1)
+            spi_writebyte2(data)
+    digital_write(cs_pin, 1)
+
+
+class Transactions:
+    """send_transaction() and send_table() for drivers with dc_pin and cs_pin."""
+
+    # A command and all of its data in one CS-asserted transaction
+    def send_transaction(self, command, data=b''):
+        send_transactions(self.dc_pin, self.cs_pin, ((command, data),))
+
+    # A table of (command, data) pairs in one CS-asserted transaction
+    def send_table(self, table):
+        send_transactions(self.dc_pin, self.cs_pin, table)
+
 ### END OF FILE ###
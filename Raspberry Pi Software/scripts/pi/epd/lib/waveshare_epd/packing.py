@@ -0,0 +1,175 @@
+# *****************************************************************************
+# * | File        :	  packing.py
+# * | Function    :   Pack PIL images into e-Paper frame buffers
+# * | Info        :
+# *----------------
+# * | Info        :   The drivers used to build their buffers with a Python
+# * |                 loop over every pixel. These functions do the same with
+# * |                 PIL's own packers and transposes, or NumPy for the 2- and
+# * |                 4-bit colour and 4-gray panels, with the same output.
+# * |                 See benchmarks/bench_packing.py.
+# ******************************************************************************
+
+import logging
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# bytes.translate() table that flips every bit of a byte
+INVERT_TABLE = bytes(0xFF - i for i in range(256))
+
+# Image.point() table from an 'L' value to the 2-bit level a 4-gray panel
+# shows, 0 (black) to 3 (white). 0xC0 is the light gray and 0x80 the dark
+# one; any other value keeps its top two bits, as in the drivers' loops.
+GRAY4_LEVELS = [(0x80 if p == 0xC0 else 0x40 if p == 0x80 else p) >> 6 for p in range(256)]
+
+
+def orient(image, width, height):
+    """Return the image in mode '1' and in panel orientation, or None.
+
+    An image that is height x width is turned 90 degrees anticlockwise,
+    like the drivers' rotated paths did. It is converted before it is
+    turned, so a greyscale image is dithered just as the old loops did it.
+    """
+    image_monocolor = image.convert('1')
+    if image_monocolor.size == (width, height):
+        return image_monocolor
+    if image_monocolor.size == (height, width):
+        return image_monocolor.transpose(Image.ROTATE_90)
+    return None
+
+
+def pack_rows(image, linewidth=None, x=0):
+    """Pack a mode '1' image into rows of linewidth bytes, first pixel in the MSB.
+
+    A set bit is white. The image starts x bits into each row, and every
+    bit of a row that it doesn't cover is set.
+    """
+    width, height = image.size
+    if linewidth is None:
+        linewidth = (x + width + 7) // 8
+    if x or linewidth * 8 != width:
+        canvas = Image.new('1', (linewidth * 8, height), 1)
+        canvas.paste(image, (x, 0))
+        image = canvas
+    return bytearray(image.tobytes('raw'))
+
+
+def pack_1bit(image, width, height, blank=0xFF):
+    """Frame buffer for a width x height 1-bit panel, in rows of whole bytes.
+
+    A set bit is white. An image that is neither width x height nor
+    height x width gives a buffer filled with blank.
+    """
+    linewidth = (width + 7) // 8
+    image_monocolor = orient(image, width, height)
+    if image_monocolor is None:
+        return bytearray([blank]) * (linewidth * height)
+    return pack_rows(image_monocolor, linewidth)
+
+
+def invert(buf):
+    """Flip every bit, for panels where a set bit is black."""
+    return bytearray(buf).translate(INVERT_TABLE)
+
+
+class Palette:
+    """A colour panel's palette, as the palette image Image.quantize() takes."""
+
+    def __init__(self, colors):
+        self.colors = tuple(colors)
+        self.image = Image.new("P", (1, 1))
+        self.image.putpalette(sum(self.colors, ()) + (0, 0, 0) * (256 - len(self.colors)))
+
+    def quantize(self, image):
+        """Palette indices for image, dithered by PIL, as a (height, width) array."""
+        indices = image.convert("RGB").quantize(palette=self.image)
+        return np.asarray(indices, dtype=np.uint8)
+
+    def match(self, image):
+        """Palette indices for pixels exactly one of the colours, 0 for the rest."""
+        rgb = np.asarray(image.convert("RGB"))
+        indices = np.zeros(rgb.shape[:2], dtype=np.uint8)
+        # Later colours lose to earlier ones, as in the drivers' elif chains
+        for index in range(len(self.colors) - 1, 0, -1):
+            indices[(rgb == self.colors[index]).all(axis=2)] = index
+        return indices
+
+
+@lru_cache(maxsize=None)
+def palette(colors):
+    """The shared Palette for a tuple of (r, g, b) colours."""
+    return Palette(colors)
+
+
+def pack_indices(indices, bits):
+    """Pack a (height, width) array of values below 2**bits, 8 // bits to a byte.
+
+    The first pixel goes in the highest bits, and rows are padded with zeros
+    to whole bytes. A 1-D array is packed as a single row.
+    """
+    per_byte = 8 // bits
+    indices = np.atleast_2d(np.asarray(indices, dtype=np.uint8))
+    pad = -indices.shape[1] % per_byte
+    if pad:
+        indices = np.pad(indices, ((0, 0), (0, pad)))
+    shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+    groups = indices.reshape(indices.shape[0], -1, per_byte) << shifts
+    return bytearray(np.bitwise_or.reduce(groups, axis=2).tobytes())
+
+
+def unpack_indices(buf, bits):
+    """Split every byte of buf into 8 // bits values, highest bits first."""
+    data = np.frombuffer(bytes(buf), dtype=np.uint8)
+    shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+    return ((data[:, None] >> shifts) & ((1 << bits) - 1)).reshape(-1)
+
+
+def lookup(table, values):
+    """Map every value through table, a sequence of one entry per value."""
+    return np.asarray(table, dtype=np.uint8)[values]
+
+
+def pack_palette(image, width, height, colors, bits):
+    """Frame buffer for a colour panel: image quantized to colors, bits per pixel.
+
+    A height x width image is first rotated 90 degrees anticlockwise.
+    """
+    imwidth, imheight = image.size
+    if imwidth == width and imheight == height:
+        pass
+    elif imwidth == height and imheight == width:
+        image = image.rotate(90, expand=True)
+    else:
+        message = "Invalid image dimensions: %d x %d, expected %d x %d" % (imwidth, imheight, width, height)
+        logger.warning(message)
+        raise ValueError(message)
+    return pack_indices(palette(tuple(colors)).quantize(image), bits)
+
+
+def pack_4gray(image, width, height, rotate=Image.ROTATE_90):
+    """Frame buffer for a width x height 4-gray panel, four pixels to a byte.
+
+    A height x width image is turned with rotate, a PIL transpose method,
+    since the drivers don't all turn it the same way. An image that is
+    neither size gives a buffer filled with 0xFF.
+    """
+    image_gray = image.convert('L')
+    if image_gray.size == (width, height):
+        pass
+    elif image_gray.size == (height, width):
+        image_gray = image_gray.transpose(rotate)
+    else:
+        return bytearray([0xFF]) * (width // 4 * height)
+    return pack_indices(np.asarray(image_gray.point(GRAY4_LEVELS)), 2)
+
+
+def gray4_plane(buf, table):
+    """One of the two 1-bit planes a 4-gray buffer is sent to the panel as.
+
+    table gives the bit for each level, black to white.
+    """
+    return bytearray(np.packbits(lookup(table, unpack_indices(buf, 2))).tobytes())
@@ -0,0 +1,142 @@
+import hashlib
+import os
+from threading import Lock
+
+import numpy as np
+
+# RGB space from LUT_ORIGIN to LUT_ORIGIN + LUT_SIZE * LUT_STEP is cut into
+# LUT_SIZE^3 cubes. The range reaches past 0-255 on both sides because error
+# diffusion pushes values outside it.
+LUT_ORIGIN = -128.0
+LUT_STEP = 8.0
+LUT_SIZE = 64
+LUT_VERSION = 1
+
+# Table entry for a cube that doesn't lie entirely inside one palette
+# colour's region. Pixels in it are matched against the palette directly.
+AMBIGUOUS = 255
+
+# How close (in squared distance) a cube may come to the boundary between
+# two colours and still get a table entry. Keeps float32 rounding in
+# nearest_palette_index() from ever disagreeing with the table.
+LUT_MARGIN = 4.0
+
+LUT_DIR = os.environ.get(
+    "MEMORYBOX_LUT_DIR", os.path.expanduser("~/.cache/memorybox/luts")
+)
+
+
+def nearest_palette_index(values, palette):
+    """Index of the nearest palette colour for each row of an (n, 3) array."""
+    distances = ((values[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1).astype(np.uint8)
+
+
+def build_table(palette):
+    """Return the (LUT_SIZE,) * 3 uint8 table of palette indices for ``palette``.
+
+    Regions of nearest colour are convex, so when the nearest colour at the
+    centre of a cube beats every other colour everywhere in the cube by more
+    than LUT_MARGIN, the whole cube maps to it. Every other cube, and every
+    cube on the outside of the grid, is AMBIGUOUS.
+    """
+    palette = np.asarray(palette, dtype=np.float64)
+    axis = LUT_ORIGIN + LUT_STEP * (np.arange(LUT_SIZE) + 0.5)
+    centers = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1)
+    centers = centers.reshape(-1, 3)
+
+    best = nearest_palette_index(centers, palette)
+    squares = (palette**2).sum(axis=1)
+    clear = np.ones(len(centers), dtype=bool)
+    for j in range(len(palette)):
+        # d_j - d_best is linear in x, so its minimum over the cube is its
+        # value at the centre less the half-width times the gradient's L1 norm
+        gradient = 2 * (palette[best] - palette[j])
+        gap = (centers * gradient).sum(axis=1) + squares[j] - squares[best]
+        slack = np.abs(gradient).sum(axis=1) * (LUT_STEP / 2)
+        clear &= (best == j) | (gap - slack > LUT_MARGIN)
+
+    table = np.where(clear, best, AMBIGUOUS).astype(np.uint8)
+    table = table.reshape(LUT_SIZE, LUT_SIZE, LUT_SIZE)
+    # Lookups clamp to the grid, so the outer shell also catches every value
+    # outside the covered range
+    for edge in (0, -1):
+        table[edge, :, :] = table[:, edge, :] = table[:, :, edge] = AMBIGUOUS
+    return table
+
+
+class PaletteLUT:
+    """RGB to palette index lookup table for one palette.
+
+    nearest() gives exactly the same indices as nearest_palette_index(), but
+    most pixels cost a single table lookup. Only pixels near the boundary
+    between two colours, or far outside 0-255, fall back to comparing
+    distances.
+    """
+
+    STRIDES = np.array([LUT_SIZE * LUT_SIZE, LUT_SIZE, 1], dtype=np.intp)
+
+    def __init__(self, palette, table):
+        self.palette = np.asarray(palette, dtype=np.float32)
+        self.table = table.reshape(-1)
+
+    @classmethod
+    def load(cls, palette, directory=LUT_DIR):
+        """Memory-map the table for ``palette``, building and saving it if needed."""
+        palette = np.asarray(palette, dtype=np.float32)
+        if len(palette) >= AMBIGUOUS:
+            raise ValueError(f"A palette can have at most {AMBIGUOUS - 1} colours.")
+
+        path = os.path.join(directory, f"palette-{cls.key(palette)}.npy")
+        try:
+            return cls(palette, np.load(path, mmap_mode="r"))
+        except (OSError, ValueError):
+            pass
+
+        table = build_table(palette)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, table)
+            os.replace(tmp_path, path)
+            table = np.load(path, mmap_mode="r")
+        except OSError as e:
+            print(f"Could not save palette LUT to {path}: {e}")
+        return cls(palette, table)
+
+    @staticmethod
+    def key(palette):
+        grid = f"{LUT_VERSION}:{LUT_ORIGIN}:{LUT_STEP}:{LUT_SIZE}:{LUT_MARGIN}"
+        digest = hashlib.sha1(grid.encode())
+        digest.update(np.ascontiguousarray(palette, dtype=np.float32).tobytes())
+        return digest.hexdigest()[:16]
+
+    def nearest(self, values):
+        """Index of the nearest palette colour for each row of an (n, 3) array."""
+        cells = ((values - LUT_ORIGIN) * (1 / LUT_STEP)).astype(np.intp)
+        np.clip(cells, 0, LUT_SIZE - 1, out=cells)
+        indices = self.table[cells @ self.STRIDES]
+
+        missed = indices == AMBIGUOUS
+        if missed.any():
+            indices[missed] = nearest_palette_index(values[missed], self.palette)
+        return indices
+
+
+_luts = {}
+_luts_lock = Lock()
+
+
+def palette_lut(palette):
+    """Return the shared PaletteLUT for ``palette``, loading it on first use.
+
+    Any panel can use this with its own palette. The 7-colour epd7in3f and
+    the 4-colour epd4in37g each get their own table, keyed by their colours.
+    """
+    palette = np.asarray(palette, dtype=np.float32)
+    key = PaletteLUT.key(palette)
+    with _luts_lock:
+        if key not in _luts:
+            _luts[key] = PaletteLUT.load(palette)
+        return _luts[key]
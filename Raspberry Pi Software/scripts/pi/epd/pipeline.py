@@ -0,0 +1,231 @@
+import resource
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# VmHWM is one figure for the whole process, and resetting it for one
+# stage would clobber the peak of a stage running in another thread. So a
+# stage's peak is only measured when its pipeline is the only one running,
+# and is None otherwise.
+_running_lock = Lock()
+_running = 0
+_started = 0
+
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (Linux 4.0+), so the peak that's
+    # reported covers one stage rather than the life of the process.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Stage:
+    """One step of a Pipeline.
+
+    ``run(context)`` returns a dict of values to add to the context; a value
+    of None removes that key, so a stage can let go of an intermediate it
+    has finished with. A stage with a ``cache`` and a ``cache_key(context)``
+    has its outputs stored after it runs.
+    """
+
+    def __init__(self, name, run, cache=None, cache_key=None):
+        self.name = name
+        self.run = run
+        self.cache = cache
+        self.cache_key = cache_key
+
+    def key(self, context):
+        if self.cache is None or self.cache_key is None:
+            return None
+        return self.cache_key(context)
+
+
+class Pipeline:
+    """Runs stages in order over a shared context dict.
+
+    Before running anything, the pipeline looks for the last stage whose
+    outputs are cached and starts right after it, so a cached intermediate
+    skips every stage up to and including the one that made it. Each stage
+    that runs is timed, with the process' peak RSS while it ran, and
+    recorded in ``metrics``. The peak is process-wide, so it is only taken
+    while no other pipeline runs alongside; otherwise it is None.
+    """
+
+    def __init__(self, name, stages, metrics=None):
+        self.name = name
+        self.stages = stages
+        self.metrics = metrics
+
+    def run(self, context):
+        global _running, _started
+        with _running_lock:
+            _running += 1
+            _started += 1
+        try:
+            return self._run(context)
+        finally:
+            with _running_lock:
+                _running -= 1
+
+    def _run(self, context):
+        timings = []
+        first = 0
+        for i in range(len(self.stages) - 1, -1, -1):
+            stage = self.stages[i]
+            key = stage.key(context)
+            outputs = self._cache_get(stage, key) if key else None
+            if outputs is not None:
+                self._apply(context, outputs)
+                timings.append((stage.name, None, None))
+                if self.metrics:
+                    self.metrics.record(self.name, stage.name, cached=True)
+                first = i + 1
+                break
+
+        for stage in self.stages[first:]:
+            with _running_lock:
+                alone = _running == 1
+                started = _started
+                if alone:
+                    reset_peak_rss()
+            start = time.monotonic()
+            outputs = stage.run(context) or {}
+            seconds = time.monotonic() - start
+            with _running_lock:
+                alone = alone and _running == 1 and _started == started
+            peak = peak_rss_mb() if alone else None
+
+            self._apply(context, outputs)
+            timings.append((stage.name, seconds, peak))
+            if self.metrics:
+                self.metrics.record(self.name, stage.name, seconds, peak)
+
+            key = stage.key(context)
+            if key:
+                try:
+                    stage.cache.put(key, outputs)
+                except Exception as e:
+                    print(f"Could not cache the {stage.name} stage: {e}")
+
+        print(f"Pipeline {self.name}: {format_timings(timings)}")
+        context["timings"] = timings
+        return context
+
+    @staticmethod
+    def _apply(context, outputs):
+        for name, value in outputs.items():
+            if value is None:
+                context.pop(name, None)
+            else:
+                context[name] = value
+
+    @staticmethod
+    def _cache_get(stage, key):
+        try:
+            return stage.cache.get(key)
+        except Exception as e:
+            print(f"Ignoring the {stage.name} stage's cache: {e}")
+            return None
+
+
+def format_timings(timings):
+    parts = []
+    for name, seconds, peak in timings:
+        if seconds is None:
+            parts.append(f"{name} cached")
+        elif peak is None:
+            parts.append(f"{name} {seconds:.3f} s")
+        else:
+            parts.append(f"{name} {seconds:.3f} s ({peak:.1f} MB)")
+    total = sum(seconds for _, seconds, _ in timings if seconds is not None)
+    return f"{', '.join(parts)}; {total:.3f} s total"
+
+
+class MemoryCache:
+    """Small in-process LRU cache of stage outputs."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            outputs = self.entries.get(key)
+            if outputs is not None:
+                self.entries.move_to_end(key)
+            return outputs
+
+    def put(self, key, outputs):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = outputs
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class PipelineMetrics:
+    """Running totals per pipeline stage, for logs and the metrics endpoint.
+
+    ``max_peak_rss_mb`` is the process' peak RSS, not the stage's own use,
+    and only counts runs that had the process to themselves.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+
+    def record(self, pipeline, stage, seconds=0.0, peak_rss_mb=None, cached=False):
+        with self.lock:
+            stats = self.stages.setdefault(
+                f"{pipeline}.{stage}",
+                {
+                    "runs": 0,
+                    "cache_hits": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                    # None until a run is measured
+                    "max_peak_rss_mb": None,
+                },
+            )
+            if cached:
+                stats["cache_hits"] += 1
+                return
+            stats["runs"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if peak_rss_mb is not None:
+                stats["max_peak_rss_mb"] = max(
+                    stats["max_peak_rss_mb"] or 0.0, peak_rss_mb
+                )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: dict(
+                    stats,
+                    average_seconds=(
+                        stats["total_seconds"] / stats["runs"] if stats["runs"] else 0.0
+                    ),
+                )
+                for name, stats in self.stages.items()
+            }
+
+
+pipeline_metrics = PipelineMetrics()
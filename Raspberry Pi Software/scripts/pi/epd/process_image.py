@@ -1,67 +1,382 @@
 import sys
+import hashlib
 import io
 import os
+import tempfile
 import traceback
+import numpy as np
 from wand.image import Image as WandImage
 from wand.color import Color
+from wand.resource import limits as wand_limits
 from PIL import Image
 
+import dither
+from dither_cache import DitherCache, file_sha256
+from frame import INVERT_TABLE, read_frame, write_frame
+from pipeline import MemoryCache, Pipeline, Stage, pipeline_metrics
+
 IMAGE_WIDTH = 800
 IMAGE_HEIGHT = 480
 
+# "wand" is the original ImageMagick path and stays the default. "numpy" is
+# Floyd-Steinberg in a single array pass: much faster, but its output isn't
+# byte-identical to ImageMagick's, so it's opt-in. "bayer" and "blue-noise"
+# are ordered dithers: grainier, but several times faster, which suits bulk
+# imports and previews.
+DITHER_BACKEND = os.environ.get("MEMORYBOX_DITHER_BACKEND", "wand")
 
-def process_image(filename, output_folder, custom_filename=None):
-    print(f"Processing file: {filename}")
+# Processes the "numpy" Floyd-Steinberg splits each band across. Worth
+# raising on multi-core boxes for large frames; see
+# benchmarks/bench_parallel_dither.py. Only single-threaded processes, like
+# the batch importer's workers, use them; the service dithers serially.
+DITHER_WORKERS = int(os.environ.get("MEMORYBOX_DITHER_WORKERS", "1"))
 
-    red_image = None
-    black_image = None
-    try:
-        with WandImage(filename=filename) as img:
-            img.resize(IMAGE_WIDTH, IMAGE_HEIGHT)
+# Most memory one image may use: for the numpy backends the decoded source
+# plus the bands of the panel image being resized and dithered, and for
+# ImageMagick its pixel cache (see limit_wand_memory). Sources PIL can't
+# decode within it are shrunk by ImageMagick instead (see shrink_with_wand),
+# so the service isn't OOM-killed whatever it's sent.
+MEMORY_CEILING_MB = int(os.environ.get("MEMORYBOX_MEMORY_CEILING_MB", "96"))
+
+# The panel image is resampled in strips of this many rows, whatever the
+# band size, so the output doesn't depend on the memory ceiling.
+RESIZE_STRIP_ROWS = 48
+
+# A band needs the resized strip, its float32 copy and the dither's working
+# rows, each row of which is about IMAGE_WIDTH * 3 * 4 bytes.
+BAND_ROW_BYTES = IMAGE_WIDTH * 3 * 4 * 3
+MIN_BAND_ROWS = RESIZE_STRIP_ROWS
+
+
+# Bump whenever a change to decoding, resizing or dithering changes the
+# planes it produces, so cached results from before are no longer used.
+PIPELINE_VERSION = 1
+
+# Processed frames are cached by original and pipeline, so re-processing
+# the library or re-adding a photo skips the dither. An empty directory
+# turns the cache off.
+DITHER_CACHE_DIR = os.environ.get(
+    "MEMORYBOX_DITHER_CACHE_DIR", "/mnt/sda2/cache/dither"
+)
+DITHER_CACHE_MB = int(os.environ.get("MEMORYBOX_DITHER_CACHE_MB", "512"))
+dither_cache = (
+    DitherCache(DITHER_CACHE_DIR, DITHER_CACHE_MB * 2**20) if DITHER_CACHE_DIR else None
+)
+
+# Resized panel images (about 1 MB each) kept in memory, so dithering the
+# same photo again with another backend skips decoding and resizing
+PANEL_CACHE_ENTRIES = int(os.environ.get("MEMORYBOX_PANEL_CACHE_ENTRIES", "4"))
+panel_cache = MemoryCache(PANEL_CACHE_ENTRIES)
+
+
+def dither_with_wand(context):
+    filename = context["filename"]
+    with WandImage() as img:
+        # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale when the image is
+        # at least twice the size asked for
+        img.options["jpeg:size"] = f"{IMAGE_WIDTH * 2}x{IMAGE_HEIGHT * 2}"
+        img.read(filename=filename)
+        img.resize(IMAGE_WIDTH, IMAGE_HEIGHT)
+
+        with WandImage() as palette1:
+            with WandImage(width=1, height=1, pseudo="xc:red") as red:
+                palette1.sequence.append(red)
+            with WandImage(width=1, height=1, pseudo="xc:black") as black:
+                palette1.sequence.append(black)
+            with WandImage(width=1, height=1, pseudo="xc:white") as white:
+                palette1.sequence.append(white)
+            palette1.concat()
+
+            img.remap(affinity=palette1, method="floyd_steinberg")
+
+            red = img.clone()
+            black = img.clone()
+
+            red.opaque_paint(target="black", fill="white")
+            black.opaque_paint(target="red", fill="white")
+
+            red_image = Image.open(io.BytesIO(red.make_blob("bmp")))
+            black_image = Image.open(io.BytesIO(black.make_blob("bmp")))
+
+            return {
+                "black_image": black_image.convert("1"),
+                "red_image": red_image.convert("1"),
+            }
+
+
+def ceiling_bytes():
+    return MEMORY_CEILING_MB * 2**20
+
+
+def limit_wand_memory():
+    # ImageMagick keeps pixels in its own cache, out of PIL's and NumPy's
+    # sight. Past these limits the cache moves to disk instead of growing in
+    # memory, so the wand backend stays under the ceiling however large the
+    # source is; it gets slower rather than OOM-killed. The limits are per
+    # process, shared by every ingest thread.
+    wand_limits["memory"] = ceiling_bytes()
+    wand_limits["map"] = ceiling_bytes()
+
+
+limit_wand_memory()
+
+
+def decode_source(context):
+    """Decode the image small enough to resample, within the memory ceiling."""
+    filename = context["filename"]
+    ceiling = ceiling_bytes()
+    with Image.open(filename) as img:
+        full_size = img.size
+        # JPEGs are decoded straight from the DCT coefficients at the
+        # smallest of 1/1, 1/2, 1/4 or 1/8 scale that still covers the panel,
+        # so a 48 MP photo never exists in memory at full size.
+        img.draft("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT))
+        width, height = img.size
+        print(f"Decoding {full_size[0]}x{full_size[1]} at {width}x{height}")
+
+        # Room for the decoded image plus one RGB copy of it
+        source_bytes = width * height * (len(img.getbands()) + 3)
+        if source_bytes + MIN_BAND_ROWS * BAND_ROW_BYTES > ceiling:
+            # PIL can only decode anything but JPEG whole
+            print(
+                f"Decoding at {width}x{height} doesn't fit the "
+                f"{MEMORY_CEILING_MB} MB memory ceiling, shrinking with ImageMagick"
+            )
+            source = shrink_with_wand(filename)
+            return {
+                "source": source,
+                "source_bytes": source.width * source.height * 6,
+            }
+
+        img.load()
+        # Anything still more than twice the panel size is shrunk by
+        # averaging whole blocks of pixels before the Lanczos resample
+        factor = min(width // (IMAGE_WIDTH * 2), height // (IMAGE_HEIGHT * 2))
+        if factor > 1 and img.mode in ("L", "RGB", "RGBA"):
+            img = img.reduce(factor)
+        return {"source": img.convert("RGB"), "source_bytes": source_bytes}
+
+
+def shrink_with_wand(filename):
+    """Decode a source too big for PIL, at most twice the panel size.
+
+    ImageMagick decodes it row by row into its pixel cache, which moves to
+    disk past the limits set by limit_wand_memory(), and shrinks each side
+    to at most twice the panel's. resize_source stretches the source to the
+    panel anyway, so that's all it needs.
+    """
+    with WandImage() as img:
+        img.options["jpeg:size"] = f"{IMAGE_WIDTH * 2}x{IMAGE_HEIGHT * 2}"
+        img.read(filename=filename)
+        img.resize(min(img.width, IMAGE_WIDTH * 2), min(img.height, IMAGE_HEIGHT * 2))
+        img.depth = 8
+        # Raw RGB of the first frame comes first in the blob
+        return Image.frombytes("RGB", img.size, img.make_blob("RGB"))
+
+
+def resize_source(context):
+    """Resample the decoded source to the panel size, strip by strip.
+
+    The panel image is kept as 8-bit RGB, which is small and the same size
+    whatever the source was. The decoded source is released afterwards.
+    """
+    img = context["source"]
+    panel = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
+    scale = img.height / IMAGE_HEIGHT
+    for top in range(0, IMAGE_HEIGHT, RESIZE_STRIP_ROWS):
+        bottom = min(IMAGE_HEIGHT, top + RESIZE_STRIP_ROWS)
+        strip = img.resize(
+            (IMAGE_WIDTH, bottom - top),
+            Image.LANCZOS,
+            box=(0, top * scale, img.width, bottom * scale),
+        )
+        panel[top:bottom] = np.asarray(strip)
+    return {"panel": panel, "source": None}
 
-            with WandImage() as palette1:
-                with WandImage(width=1, height=1, pseudo="xc:red") as red:
-                    palette1.sequence.append(red)
-                with WandImage(width=1, height=1, pseudo="xc:black") as black:
-                    palette1.sequence.append(black)
-                with WandImage(width=1, height=1, pseudo="xc:white") as white:
-                    palette1.sequence.append(white)
-                palette1.concat()
 
-                img.remap(affinity=palette1, method="floyd_steinberg")
+def panel_cache_key(context):
+    return (
+        f"{context['source_sha256']}:{PIPELINE_VERSION}:"
+        f"{IMAGE_WIDTH}x{IMAGE_HEIGHT}:{RESIZE_STRIP_ROWS}"
+    )
 
-                red = img.clone()
-                black = img.clone()
 
-                red.opaque_paint(target="black", fill="white")
-                black.opaque_paint(target="red", fill="white")
+def pixel_bands(context):
+    """Yield the panel image in (rows, IMAGE_WIDTH, 3) float32 bands.
 
-                red_image = Image.open(io.BytesIO(red.make_blob("bmp")))
-                black_image = Image.open(io.BytesIO(black.make_blob("bmp")))
+    Bands are as tall as the memory ceiling allows once the decoded source
+    is paid for, so peak memory stays under the ceiling however large the
+    source is.
+    """
+    budget = ceiling_bytes() - context.get("source_bytes", 0)
+    band_rows = budget // BAND_ROW_BYTES // RESIZE_STRIP_ROWS * RESIZE_STRIP_ROWS
+    band_rows = max(MIN_BAND_ROWS, min(IMAGE_HEIGHT, band_rows))
 
-                red_image = red_image.convert("1")
-                black_image = black_image.convert("1")
+    panel = context["panel"]
+    for top in range(0, IMAGE_HEIGHT, band_rows):
+        yield panel[top : top + band_rows].astype(np.float32)
 
-                base_filename = (
-                    custom_filename
-                    if custom_filename
-                    else os.path.splitext(os.path.basename(filename))[0]
-                )
-                os.makedirs(output_folder, exist_ok=True)
-                black_output_path = os.path.join(
-                    output_folder, f"{base_filename}-black.bmp"
-                )
-                red_output_path = os.path.join(
-                    output_folder, f"{base_filename}-red.bmp"
-                )
 
-                print(f"Saving black image to {black_output_path}")
-                print(f"Saving red image to {red_output_path}")
+def planes_from_index_bands(index_bands):
+    """Build the black and red plane images from bands of palette indices."""
+    black = bytearray()
+    red = bytearray()
+    for indices in index_bands:
+        black += dither.pack_plane(indices == dither.BLACK)
+        red += dither.pack_plane(indices == dither.RED)
 
-                black_image.save(black_output_path)
-                red_image.save(red_output_path)
+    size = (IMAGE_WIDTH, IMAGE_HEIGHT)
+    return {
+        "black_image": Image.frombytes("1", size, bytes(black)),
+        "red_image": Image.frombytes("1", size, bytes(red)),
+        # Dithered; the panel image stays in the panel cache
+        "panel": None,
+    }
+
+
+def ordered_index_bands(context, thresholds):
+    first_row = 0
+    for band in pixel_bands(context):
+        yield dither.ordered_dither(band, thresholds, first_row=first_row)
+        first_row += len(band)
+
+
+def dither_with_numpy(context):
+    return planes_from_index_bands(
+        dither.floyd_steinberg_bands(pixel_bands(context), workers=DITHER_WORKERS)
+    )
+
+
+def dither_with_bayer(context):
+    return planes_from_index_bands(ordered_index_bands(context, dither.bayer_matrix()))
+
+
+def dither_with_blue_noise(context):
+    return planes_from_index_bands(
+        ordered_index_bands(context, dither.blue_noise_matrix())
+    )
+
+
+def cache_key(source_sha256, backend):
+    """Key for the planes `backend` makes from an original with this hash."""
+    key = hashlib.sha256()
+    key.update(
+        f"{source_sha256}:{PIPELINE_VERSION}:{backend}:"
+        f"{IMAGE_WIDTH}x{IMAGE_HEIGHT}:{RESIZE_STRIP_ROWS}:"
+        f"{dither.ORDERED_SPREAD}:".encode()
+    )
+    key.update(dither.PALETTE.tobytes())
+    return key.hexdigest()
+
+
+def planes_from_frame(path):
+    width, height, black, red = read_frame(path)
+    black_image = Image.frombytes("1", (width, height), black)
+    red_image = Image.frombytes("1", (width, height), red.translate(INVERT_TABLE))
+    return black_image, red_image
+
+
+class FrameCache:
+    """Stage cache for dithered planes, stored in the dither cache as frames."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def get(self, key):
+        path = self.files.get(key)
+        if path is None:
+            return None
+        black_image, red_image = planes_from_frame(path)
+        return {"black_image": black_image, "red_image": red_image}
+
+    def put(self, key, outputs):
+        # Unique per call, as pipelines in other threads may store the same key
+        fd, tmp_path = tempfile.mkstemp(suffix=".epd")
+        os.close(fd)
+        try:
+            write_frame(tmp_path, outputs["black_image"], outputs["red_image"])
+            self.files.put(key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def save_outputs(context):
+    base_filename = (
+        context["custom_filename"]
+        if context["custom_filename"]
+        else os.path.splitext(os.path.basename(context["filename"]))[0]
+    )
+    output_folder = context["output_folder"]
+    os.makedirs(output_folder, exist_ok=True)
+    black_output_path = os.path.join(output_folder, f"{base_filename}-black.bmp")
+    red_output_path = os.path.join(output_folder, f"{base_filename}-red.bmp")
+    frame_output_path = os.path.join(output_folder, f"{base_filename}-frame.epd")
+
+    print(f"Saving black image to {black_output_path}")
+    print(f"Saving red image to {red_output_path}")
+    print(f"Saving panel frame to {frame_output_path}")
+
+    context["black_image"].save(black_output_path)
+    context["red_image"].save(red_output_path)
+    write_frame(frame_output_path, context["black_image"], context["red_image"])
+    return {
+        "black_path": black_output_path,
+        "red_path": red_output_path,
+        "frame_path": frame_output_path,
+    }
+
+
+def dither_stage(backend, run):
+    return Stage(
+        "dither",
+        run,
+        cache=FrameCache(dither_cache) if dither_cache is not None else None,
+        cache_key=lambda context: cache_key(context["source_sha256"], backend),
+    )
+
+
+DECODE = Stage("decode", decode_source)
+RESIZE = Stage("resize", resize_source, cache=panel_cache, cache_key=panel_cache_key)
+SAVE = Stage("save", save_outputs)
+
+# The stages that turn an image file into black and red planes, per backend
+DITHER_BACKENDS = {
+    "numpy": [DECODE, RESIZE, dither_stage("numpy", dither_with_numpy)],
+    "wand": [dither_stage("wand", dither_with_wand)],
+    "bayer": [DECODE, RESIZE, dither_stage("bayer", dither_with_bayer)],
+    "blue-noise": [DECODE, RESIZE, dither_stage("blue-noise", dither_with_blue_noise)],
+}
+
+PIPELINES = {
+    backend: Pipeline(backend, stages + [SAVE], pipeline_metrics)
+    for backend, stages in DITHER_BACKENDS.items()
+}
+
+
+def process_image(
+    filename, output_folder, custom_filename=None, backend=None, source_sha256=None
+):
+    """Dither an image into black and red plane bitmaps and a panel frame.
+
+    `source_sha256` is the hash of the file, if the caller already has it.
+    """
+    backend = backend or DITHER_BACKEND
+    print(f"Processing file: {filename} (dither backend: {backend})")
+
+    try:
+        if backend not in PIPELINES:
+            raise ValueError(f"Unknown dither backend '{backend}'.")
 
-                return black_output_path, red_output_path
+        context = PIPELINES[backend].run(
+            {
+                "filename": filename,
+                "output_folder": output_folder,
+                "custom_filename": custom_filename,
+                "source_sha256": source_sha256 or file_sha256(filename),
+            }
+        )
+        return context["black_path"], context["red_path"], context["frame_path"]
 
     except Exception as ex:
         print(f"traceback.format_exc():\n{traceback.format_exc()}")
@@ -74,9 +389,10 @@ if __name__ == "__main__":
     file_path = sys.argv[1] if len(sys.argv) > 1 else "sample.jpeg"
     output_folder = sys.argv[2] if len(sys.argv) > 2 else "output"
     custom_filename = sys.argv[3] if len(sys.argv) > 3 else None
+    backend = sys.argv[4] if len(sys.argv) > 4 else None
 
-    red_image, black_image = process_image(file_path, output_folder, custom_filename)
+    result = process_image(file_path, output_folder, custom_filename, backend)
 
-    if red_image is None or black_image is None:
+    if result is None:
         print("Error processing image")
         sys.exit(1)
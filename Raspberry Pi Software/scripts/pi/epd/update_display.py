@@ -6,10 +6,10 @@ import os
 import time
 from PIL import Image
 import logging
-from threading import Lock
-
-display_update_lock = Lock()
-
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from frame import read_frame
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "lib"))
 
@@ -24,95 +24,312 @@ logging.basicConfig(level=logging.DEBUG)
 TIME_LIMIT = 180  # Time limit in seconds
 LAST_UPDATE_FILE = "/home/mikebuss/services/memorybox/last_update_time.txt"
 
+# A full white refresh before every image roughly doubles the update time.
+# The three-color waveform already drives every pixel, so it's off by default.
+CLEAR_BEFORE_DISPLAY = False
 
-def safe_update_display(black_image_path, red_image_path):
-    with display_update_lock:
-        update_display(black_image_path, red_image_path)
 
+class DisplaySession:
+    """Keeps the panel's SPI/GPIO handles open across updates.
 
-def update_display(bw_path, red_path):
-    logging.info("Starting EPD update process.")
+    The panel is powered off between updates rather than put into deep
+    sleep, so the next update only needs POWER ON instead of a hardware
+    reset and the full register setup.
+    """
+
+    CLOSED = "closed"  # SPI/GPIO not set up
+    ASLEEP = "asleep"  # Deep sleep, registers lost
+    POWERED_OFF = "powered off"  # Registers kept, high voltages off
+    READY = "ready"
+
+    def __init__(self, clear_before_display=CLEAR_BEFORE_DISPLAY):
+        self.epd = epd7in5b_V2.EPD()
+        self.state = self.CLOSED
+        self.clear_before_display = clear_before_display
+
+    def wake(self):
+        if self.state == self.CLOSED:
+            logging.info("Initializing the EPD.")
+            if self.epd.init() != 0:
+                raise RuntimeError("Failed to initialize the EPD.")
+        elif self.state == self.ASLEEP:
+            logging.info("Waking the EPD from deep sleep.")
+            self.epd.wake()
+        elif self.state == self.POWERED_OFF:
+            logging.info("Powering on the EPD.")
+            self.epd.power_on()
+        self.state = self.READY
+
+    def display_frame(self, black_plane, red_plane, clear=None):
+        self.wake()
+        if self.clear_before_display if clear is None else clear:
+            logging.info("Clearing the EPD.")
+            self.epd.Clear()
+        self.epd.display_frame(black_plane, red_plane)
+        self.power_off()
+
+    def display_images(self, black_image, red_image, clear=None):
+        self.display_frame(
+            self.epd.getbuffer_black(black_image),
+            self.epd.getbuffer(red_image),
+            clear,
+        )
+
+    def clear(self):
+        self.wake()
+        self.epd.Clear()
+        self.power_off()
+
+    def power_off(self):
+        if self.state == self.READY:
+            logging.info("Powering off the EPD.")
+            self.epd.power_off()
+            self.state = self.POWERED_OFF
+
+    def sleep(self):
+        if self.state in (self.READY, self.POWERED_OFF):
+            self.power_off()
+            logging.info("Putting EPD to sleep.")
+            self.epd.deep_sleep()
+            self.state = self.ASLEEP
+
+    def close(self):
+        if self.state != self.CLOSED:
+            self.sleep()
+            # Give the panel time to settle before cutting its power
+            epd7in5b_V2.epdconfig.delay_ms(2000)
+            self.abort()
+
+    def abort(self):
+        try:
+            epd7in5b_V2.epdconfig.module_exit()
+        except Exception as e:
+            logging.error("An exception occurred while closing the EPD: {}".format(e))
+        self.state = self.CLOSED
+
+
+class DisplayWorker:
+    """Runs display jobs one at a time on a single background thread.
+
+    Image updates are coalesced: submitting one cancels any update still
+    waiting, so a burst of requests ends with the latest frame on the panel
+    instead of showing every frame in turn. Jobs submitted with
+    coalesce=False, like clears, are never dropped; they keep their place in
+    the queue and run in order with the surviving update. The TIME_LIMIT
+    wait also happens here, so callers get a Future straight away.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.pending = deque()
+        self.closed = False
+        self.thread = None
+
+    def submit(self, func, *args, wait_for_time_limit=True, coalesce=True):
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The display worker has been shut down.")
+            if coalesce:
+                self._drop_superseded()
+            self.pending.append((future, func, args, wait_for_time_limit, coalesce))
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="display-worker")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def shutdown(self, final_func=None, timeout=None):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            # Pending clears still run before final_func
+            self._drop_superseded()
+            if final_func:
+                self.pending.append((Future(), final_func, (), False, False))
+            thread = self.thread
+            self.condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+        elif final_func is not None:
+            final_func()
+
+    def _drop_superseded(self):
+        kept = deque()
+        for job in self.pending:
+            if job[4]:
+                logging.info("Dropping a display update superseded by a newer one.")
+                job[0].cancel()
+            else:
+                kept.append(job)
+        self.pending = kept
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                if not self.pending:
+                    if self.closed:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                wait_time = seconds_until_next_update() if self.pending[0][3] else 0
+                if wait_time <= 0:
+                    return self.pending.popleft()
+
+                # A newer submission wakes us up and may replace the waiting job
+                logging.info(f"Next display update in {int(wait_time)} seconds.")
+                self.condition.wait(wait_time)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            future, func, args, _, _ = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                logging.error(
+                    "An exception occurred in the display worker: {}".format(e)
+                )
+                future.set_exception(e)
 
+
+display_session = DisplaySession()
+display_worker = DisplayWorker()
+
+
+def safe_update_display(black_image_path, red_image_path, frame_path=None):
+    """Queue a display update and return a Future for its (success, message)."""
+    return display_worker.submit(
+        update_display, black_image_path, red_image_path, frame_path, display_session
+    )
+
+
+def safe_clear_display():
+    """Queue a clear of the panel, after which it is left in deep sleep."""
+    # Clears protect the panel from ghosting, so a later update mustn't drop one
+    return display_worker.submit(clear_and_sleep, display_session, coalesce=False)
+
+
+def close_display(timeout=60):
+    display_worker.shutdown(display_session.close, timeout)
+
+
+def seconds_until_next_update():
     # Check if the last update file exists
     if os.path.exists(LAST_UPDATE_FILE):
-        logging.info(f"The last update file '{LAST_UPDATE_FILE}' exists.")
         with open(LAST_UPDATE_FILE, "r") as f:
             last_update_time = float(f.read().strip())
         elapsed_time = time.time() - last_update_time
-        logging.info(f"{elapsed_time:.2f} seconds have elapsed since the last update.")
-
-        if elapsed_time < TIME_LIMIT:
-            wait_time = TIME_LIMIT - elapsed_time
-            logging.info(f"Need to wait for an additional {int(wait_time)} seconds.")
-            for remaining in range(int(wait_time), 0, -1):
-                sys.stdout.write(f"\r{remaining} seconds remaining.")
-                sys.stdout.flush()
-                time.sleep(1)
-            print()
-    else:
-        logging.info(f"The last update file '{LAST_UPDATE_FILE}' does not exist.")
+        logging.debug(f"{elapsed_time:.2f} seconds have elapsed since the last update.")
+        return max(0.0, TIME_LIMIT - elapsed_time)
+
+    logging.info(f"The last update file '{LAST_UPDATE_FILE}' does not exist.")
+
+    # Create the file and set the last update time to the current time minus TIME_LIMIT
+    with open(LAST_UPDATE_FILE, "w") as f:
+        last_update_time = time.time() - TIME_LIMIT
+        f.write(str(last_update_time))
+    return 0.0
+
 
-        # Create the file and set the last update time to the current time minus TIME_LIMIT
-        with open(LAST_UPDATE_FILE, "w") as f:
-            last_update_time = time.time() - TIME_LIMIT
-            f.write(str(last_update_time))
+def record_update_time():
+    logging.info("Updating the last update time.")
+    with open(LAST_UPDATE_FILE, "w") as f:
+        f.write(str(time.time()))
 
+
+def clear_and_sleep(session):
     try:
-        # Initialize EPD
-        logging.info("Initializing the EPD.")
-        epd = epd7in5b_V2.EPD()
-        epd.init()
-        epd.Clear()
-
-        # Check if files exist
-        if os.path.exists(bw_path) and os.path.exists(red_path):
-            logging.info("Both image files exist.")
-        else:
-            logging.error("One or both image files do not exist.")
-            return False, "One or both image files do not exist."
+        logging.info("Clearing the EPD and putting it to sleep.")
+        session.clear()
+        session.sleep()
+        record_update_time()
+        return True, "Successfully cleared EPD."
+    except Exception as e:
+        logging.error("An exception occurred: {}".format(e))
+        session.abort()
+        return False, str(e)
+
 
-        # Load Images
-        logging.info("Loading image files.")
-        Himage_bw = Image.open(bw_path)
-        Himage_red = Image.open(red_path)
+def update_display(bw_path, red_path, frame_path=None, session=None):
+    logging.info("Starting EPD update process.")
 
-        # Check image resolutions
-        if Himage_bw.size == (800, 480) and Himage_red.size == (800, 480):
-            logging.info("Image resolutions are correct.")
+    wait_time = seconds_until_next_update()
+    if wait_time > 0:
+        logging.info(f"Need to wait for an additional {int(wait_time)} seconds.")
+        time.sleep(wait_time)
+
+    # Without a long-lived session, open one just for this update
+    one_shot = session is None
+    if one_shot:
+        session = DisplaySession()
+
+    try:
+        if frame_path and os.path.exists(frame_path):
+            # Fast path: the frame was packed for the panel at ingest time.
+            logging.info("Loading frame file.")
+            width, height, black_plane, red_plane = read_frame(frame_path)
+            if (width, height) != (session.epd.width, session.epd.height):
+                logging.error("Frame resolution must be 800x480.")
+                return False, "Frame resolution must be 800x480."
+
+            logging.info("Updating the EPD from frame file.")
+            session.display_frame(black_plane, red_plane)
         else:
-            logging.error("Image resolution must be 800x480.")
-            return False, "Image resolution must be 800x480."
+            # Check if files exist
+            if os.path.exists(bw_path) and os.path.exists(red_path):
+                logging.info("Both image files exist.")
+            else:
+                logging.error("One or both image files do not exist.")
+                return False, "One or both image files do not exist."
+
+            # Load Images
+            logging.info("Loading image files.")
+            Himage_bw = Image.open(bw_path)
+            Himage_red = Image.open(red_path)
+
+            # Check image resolutions
+            if Himage_bw.size == (800, 480) and Himage_red.size == (800, 480):
+                logging.info("Image resolutions are correct.")
+            else:
+                logging.error("Image resolution must be 800x480.")
+                return False, "Image resolution must be 800x480."
 
-        # Update EPD
-        logging.info("Updating the EPD.")
-        epd.display(epd.getbuffer(Himage_bw), epd.getbuffer(Himage_red))
+            # Update EPD
+            logging.info("Updating the EPD.")
+            session.display_images(Himage_bw, Himage_red)
 
-        # Sleep
-        logging.info("Putting EPD to sleep.")
-        epd.sleep()
+        if one_shot:
+            session.close()
 
-        # Update last update time
-        logging.info("Updating the last update time.")
-        with open(LAST_UPDATE_FILE, "w") as f:
-            f.write(str(time.time()))
+        record_update_time()
 
         logging.info("EPD update process completed successfully.")
         return True, "Successfully updated EPD."
 
     except Exception as e:
         logging.error("An exception occurred: {}".format(e))
-        epd7in5b_V2.epdconfig.module_exit()
+        session.abort()
         return False, str(e)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         logging.error(
-            "Usage: python epd_update.py [black/white image path] [red image path]"
+            "Usage: python epd_update.py [black/white image path] [red image path] [frame path]"
         )
         sys.exit(1)
 
-    success, message = update_display(sys.argv[1], sys.argv[2])
+    frame_path = sys.argv[3] if len(sys.argv) == 4 else None
+    success, message = update_display(sys.argv[1], sys.argv[2], frame_path)
     if success:
         logging.info(f"Success: {message}")
     else:
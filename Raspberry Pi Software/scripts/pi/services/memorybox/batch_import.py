@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+sys.path.append("/home/mikebuss/epd/")
+from PIL import Image
+from process_image import DITHER_BACKENDS, process_image
+from dither_cache import file_sha256
+from ingest_workspace import IngestWorkspace
+from db import db_pool
+from perceptual_hash import dhash, to_signed
+from utilities import compute_md5, ensure_mount
+
+IMAGE_FOLDER = "/mnt/sda2/images"
+STAGING_FOLDER = "/mnt/sda2/tmp"
+ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "bmp"}
+
+# Processed images are stored this many at a time, each lot in one
+# transaction. Stopping the import loses at most one lot of work.
+BATCH_SIZE = 50
+PROGRESS_SECONDS = 5
+
+# Photos handed to the worker pool at once, per worker
+IN_FLIGHT_PER_WORKER = 2
+
+EXIF_IFD = 0x8769
+EXIF_DATE_TIME_ORIGINAL = 36867
+
+MEDIA_COLUMNS = (
+    "id",
+    "date_taken",
+    "description",
+    "image_url",
+    "image_path",
+    "black_image_path",
+    "red_image_path",
+    "frame_path",
+    "black_image_md5",
+    "red_image_md5",
+    "original_sha256",
+    "perceptual_hash",
+)
+
+# Hashes already in the library, set in each worker process by init_worker
+known_sha256 = frozenset()
+
+
+def find_items(source):
+    """Yield the photos to import from a directory or a JSON lines manifest.
+
+    Each manifest line is an object with a "path" (relative to the manifest)
+    and optionally "date", "description" and "people", like the "media"
+    object the service receives.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.rsplit(".", 1)[-1].lower() in ALLOWED_EXTENSIONS:
+                    yield {"path": os.path.join(root, name)}
+        return
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                item["path"] = os.path.join(base, item["path"])
+                yield item
+
+
+def exif_date_taken(path):
+    try:
+        with Image.open(path) as img:
+            value = img.getexif().get_ifd(EXIF_IFD).get(EXIF_DATE_TIME_ORIGINAL)
+    except Exception:
+        return None
+    # "YYYY:MM:DD HH:MM:SS", or blanks when the camera didn't know
+    try:
+        return time.strftime("%Y-%m-%d", time.strptime(value[:10], "%Y:%m:%d"))
+    except (TypeError, ValueError):
+        return None
+
+
+def init_worker(known):
+    global known_sha256
+    known_sha256 = known
+
+
+def prepare(number, item, staging_folder, backend):
+    """Process one photo into the staging folder. Runs in a worker process."""
+    path = item["path"]
+    original_sha256 = file_sha256(path)
+    if original_sha256 in known_sha256:
+        return {"item": item, "status": "duplicate"}
+
+    result = process_image(
+        path, staging_folder, str(number), backend, source_sha256=original_sha256
+    )
+    if result is None:
+        return {"item": item, "status": "failed", "error": "Image processing failed."}
+
+    black_path, red_path, frame_path = result
+    return {
+        "item": item,
+        "status": "processed",
+        "black_path": black_path,
+        "red_path": red_path,
+        "frame_path": frame_path,
+        "black_image_md5": compute_md5(black_path),
+        "red_image_md5": compute_md5(red_path),
+        "original_sha256": original_sha256,
+        "perceptual_hash": dhash(path),
+        "date_taken": item.get("date") or exif_date_taken(path),
+    }
+
+
+def copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+    )
+
+
+def store(batch, image_folder):
+    """Move a lot of processed photos into place and COPY their rows in."""
+    moved = []
+    try:
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT nextval('media_id_seq') FROM generate_series(1, %s)",
+                (len(batch),),
+            )
+            media_ids = [media_id for (media_id,) in cur.fetchall()]
+
+            media_rows = []
+            links = []
+            for media_id, result in zip(media_ids, batch):
+                item = result["item"]
+                paths = {
+                    "black": os.path.join(image_folder, f"{media_id}-B.bmp"),
+                    "red": os.path.join(image_folder, f"{media_id}-R.bmp"),
+                    "original": os.path.join(image_folder, f"{media_id}-O.bmp"),
+                    "frame": os.path.join(image_folder, f"{media_id}-F.epd"),
+                }
+                os.replace(result["black_path"], paths["black"])
+                moved.append(paths["black"])
+                os.replace(result["red_path"], paths["red"])
+                moved.append(paths["red"])
+                os.replace(result["frame_path"], paths["frame"])
+                moved.append(paths["frame"])
+                # The archive keeps its copy of the original
+                shutil.copyfile(item["path"], paths["original"])
+                moved.append(paths["original"])
+
+                media_rows.append(
+                    (
+                        media_id,
+                        result["date_taken"],
+                        item.get("description")
+                        or os.path.splitext(os.path.basename(item["path"]))[0],
+                        item.get("url"),
+                        paths["original"],
+                        paths["black"],
+                        paths["red"],
+                        paths["frame"],
+                        result["black_image_md5"],
+                        result["red_image_md5"],
+                        result["original_sha256"],
+                        to_signed(result["perceptual_hash"]),
+                    )
+                )
+                links.extend((media_id, name) for name in item.get("people", []))
+
+            copy_rows(cur, "media", MEDIA_COLUMNS, media_rows)
+
+            if links:
+                names = sorted({name for _, name in links})
+                cur.execute(
+                    "INSERT INTO people (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING",
+                    (names,),
+                )
+                cur.execute(
+                    "SELECT name, id FROM people WHERE name = ANY(%s)", (names,)
+                )
+                person_ids = dict(cur.fetchall())
+                copy_rows(
+                    cur,
+                    "media_people",
+                    ("media_id", "person_id"),
+                    {(media_id, person_ids[name]) for media_id, name in links},
+                )
+    except Exception:
+        for path in moved:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+class ImportProgress:
+    def __init__(self, total):
+        self.total = total
+        self.counts = {"imported": 0, "duplicate": 0, "failed": 0}
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def add(self, status, count=1):
+        self.counts[status] += count
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_SECONDS:
+            return
+        self.last_report = now
+
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = (self.total - self.done) / rate if rate else 0.0
+        print(
+            f"{self.done}/{self.total} photos "
+            f"({self.counts['imported']} imported, "
+            f"{self.counts['duplicate']} duplicates, "
+            f"{self.counts['failed']} failed) "
+            f"in {elapsed:.0f} s, {rate:.2f} photos/s, "
+            f"about {remaining / 60:.0f} min left",
+            flush=True,
+        )
+
+
+def load_known_checksums():
+    with db_pool.cursor() as cur:
+        cur.execute("SELECT original_sha256, black_image_md5, red_image_md5 FROM media")
+        rows = cur.fetchall()
+    return (
+        {row[0] for row in rows if row[0]},
+        {row[1] for row in rows if row[1]},
+        {row[2] for row in rows if row[2]},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import a directory or JSON lines manifest of photos into MemoryBox. "
+        "Photos already in the library are skipped, so an interrupted import "
+        "can simply be run again."
+    )
+    parser.add_argument("source", help="directory of photos or a .jsonl manifest")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--dither", choices=sorted(DITHER_BACKENDS), default=None)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--image-folder", default=IMAGE_FOLDER)
+    parser.add_argument("--staging-folder", default=STAGING_FOLDER)
+    args = parser.parse_args()
+
+    ensure_mount()
+
+    items = list(find_items(args.source))
+    known_sha256, known_black_md5, known_red_md5 = load_known_checksums()
+    print(f"Found {len(items)} photos, {len(known_sha256)} hashes already stored.")
+
+    progress = ImportProgress(len(items))
+    failures = []
+    batch = []
+
+    # Staged planes live on the same filesystem as the image folder, so
+    # storing them is a rename. Workers come from a forkserver rather than a
+    # fork of this process, which by now holds open Postgres connections
+    # that a forked child could corrupt.
+    with IngestWorkspace(args.staging_folder) as workspace, ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_worker,
+        initargs=(frozenset(known_sha256),),
+    ) as executor:
+        queued = iter(enumerate(items))
+        in_flight = {}
+        try:
+            while True:
+                # Only a few photos per worker are handed to the pool at a
+                # time, so memory stays flat and an abort has little to wait
+                # for
+                while len(in_flight) < args.workers * IN_FLIGHT_PER_WORKER:
+                    next_item = next(queued, None)
+                    if next_item is None:
+                        break
+                    number, item = next_item
+                    future = executor.submit(
+                        prepare, number, item, workspace.path, args.dither
+                    )
+                    in_flight[future] = item
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"item": item, "status": "failed", "error": str(e)}
+
+                    status = result["status"]
+                    if status == "processed":
+                        checksums = (
+                            result["original_sha256"],
+                            result["black_image_md5"],
+                            result["red_image_md5"],
+                        )
+                        # Catches repeats within this import and rows stored
+                        # before originals were hashed
+                        if (
+                            checksums[0] in known_sha256
+                            or checksums[1] in known_black_md5
+                            or checksums[2] in known_red_md5
+                        ):
+                            status = "duplicate"
+                        else:
+                            known_sha256.add(checksums[0])
+                            known_black_md5.add(checksums[1])
+                            known_red_md5.add(checksums[2])
+                            batch.append(result)
+
+                    if status == "processed":
+                        if len(batch) >= args.batch_size:
+                            store(batch, args.image_folder)
+                            progress.add("imported", len(batch))
+                            batch = []
+                    else:
+                        progress.add(status)
+                        if status == "failed":
+                            failures.append(result)
+                    progress.report()
+
+            if batch:
+                store(batch, args.image_folder)
+                progress.add("imported", len(batch))
+        except BaseException:
+            # Report the error now rather than after every queued photo
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    progress.report(force=True)
+    for failure in failures:
+        print(f"Failed: {failure['item']['path']}: {failure['error']}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import logging
+import os
+import queue
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from threading import Lock, Thread
+
+# Each ingest has its own workspace, so one worker per core is safe
+INGEST_WORKERS = os.cpu_count() or 1
+INGEST_MAX_PENDING = 16
+INGEST_JOB_HISTORY = 256
+
+
+class IngestQueue:
+    """Bounded queue of ingest jobs run by a fixed pool of worker threads.
+
+    A job is a function returning a (body, http_status) pair. Its state can
+    be looked up by id until it falls out of the most recent
+    INGEST_JOB_HISTORY jobs.
+    """
+
+    def __init__(
+        self,
+        workers=INGEST_WORKERS,
+        max_pending=INGEST_MAX_PENDING,
+        history=INGEST_JOB_HISTORY,
+    ):
+        self.workers = workers
+        self.history = history
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self._run, name=f"ingest-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        """Queue a job and return its id. Raises queue.Full when at capacity."""
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "http_status": None,
+            "result": None,
+        }
+        with self.lock:
+            self.queue.put_nowait((job, func, args))
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        logging.info("Queued ingest job %s", job["id"])
+        return job["id"]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "pending": self.queue.qsize(),
+                "max_pending": self.queue.maxsize,
+            }
+
+    def _run(self):
+        while True:
+            job, func, args = self.queue.get()
+            with self.lock:
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            logging.info("Running ingest job %s", job["id"])
+
+            try:
+                body, http_status = func(*args)
+                status = "done" if http_status < 400 else "failed"
+            except Exception as e:
+                logging.error(
+                    "Ingest job %s failed:\n%s", job["id"], traceback.format_exc()
+                )
+                body, http_status, status = {"error": str(e)}, 500, "failed"
+
+            with self.lock:
+                job["status"] = status
+                job["result"] = body
+                job["http_status"] = http_status
+                job["finished_at"] = time.time()
+            logging.info(
+                "Ingest job %s finished with status %s in %.1f seconds",
+                job["id"],
+                http_status,
+                job["finished_at"] - job["started_at"],
+            )
+            self.queue.task_done()
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import random
+from threading import Lock
+
+
+class MediaRotation:
+    """Shuffled rotation of media ids that shows every item once per pass.
+
+    Ids before `position` in the deck have already been shown in the current
+    pass. Picking, adding and removing an id are all O(1); the deck is only
+    walked when a pass ends and it gets reshuffled.
+
+    Adding and removing ids only marks the deck as changed; it's written out
+    by the next pick, so a burst of uploads costs one deck write rather than
+    one each. The ids would be lost on a crash before then, but sync() and
+    the pick's own scan for new ids restore them from the database. Picking
+    without changes only rewrites a small cursor file, so it stays cheap
+    however big the library gets.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.cursor_path = f"{os.path.splitext(state_path)[0]}.cursor.json"
+        self.lock = Lock()
+        self.deck = []
+        self.index = {}
+        self.position = 0
+        self.generation = 0
+        self.max_id = 0
+        self.dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.deck)
+
+    def load(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error("Could not read media rotation state: %s", e)
+            return
+
+        self.deck = state["deck"]
+        self.index = {media_id: i for i, media_id in enumerate(self.deck)}
+        self.generation = state["generation"]
+        self.position = state["position"]
+        self.max_id = max(self.deck, default=0)
+
+        # The cursor is only valid for the deck it was written against
+        try:
+            with open(self.cursor_path, "r") as f:
+                cursor = json.load(f)
+            if cursor["generation"] == self.generation:
+                self.position = cursor["position"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.position = min(self.position, len(self.deck))
+
+    def sync(self, media_ids):
+        """Reconcile the deck with the complete set of ids in the database."""
+        media_ids = set(media_ids)
+        with self.lock:
+            for media_id in [m for m in self.deck if m not in media_ids]:
+                self._remove(media_id)
+            for media_id in media_ids:
+                self._add(media_id)
+            self._save_deck()
+
+    def add(self, media_id):
+        with self.lock:
+            if self._add(media_id):
+                self.dirty = True
+
+    def remove(self, media_id):
+        with self.lock:
+            if self._remove(media_id):
+                self.dirty = True
+
+    def next(self, avoid=None):
+        """Return the next media id to show, or None if there is nothing to show.
+
+        `avoid` (usually the id on the panel right now) is only returned when
+        it's the only choice.
+        """
+        with self.lock:
+            if not self.deck:
+                return None
+            if self.position >= len(self.deck):
+                self._reshuffle(avoid)
+            else:
+                self._skip(avoid)
+
+            media_id = self.deck[self.position]
+            self.position += 1
+            if self.dirty:
+                self._save_deck()
+            else:
+                self._save_cursor()
+            return media_id
+
+    def _add(self, media_id):
+        if media_id in self.index:
+            return False
+        # Drop the new id somewhere in the part of the deck not yet shown
+        self.deck.append(media_id)
+        self.index[media_id] = len(self.deck) - 1
+        self._swap(
+            len(self.deck) - 1, random.randint(self.position, len(self.deck) - 1)
+        )
+        self.max_id = max(self.max_id, media_id)
+        return True
+
+    def _remove(self, media_id):
+        i = self.index.get(media_id)
+        if i is None:
+            return False
+        if i < self.position:
+            # Keep the shown ids contiguous by moving the hole to the boundary
+            self.position -= 1
+            self._swap(i, self.position)
+            i = self.position
+        self._swap(i, len(self.deck) - 1)
+        self.deck.pop()
+        del self.index[media_id]
+        return True
+
+    def _swap(self, i, j):
+        deck = self.deck
+        deck[i], deck[j] = deck[j], deck[i]
+        self.index[deck[i]] = i
+        self.index[deck[j]] = j
+
+    def _skip(self, avoid):
+        # Swap avoid out of the next slot for a random id still to be shown
+        if self.deck[self.position] == avoid and self.position < len(self.deck) - 1:
+            self._swap(
+                self.position, random.randint(self.position + 1, len(self.deck) - 1)
+            )
+
+    def _reshuffle(self, avoid=None):
+        if avoid is None and self.position:
+            avoid = self.deck[-1]
+        random.shuffle(self.deck)
+        self.index = {media_id: i for i, media_id in enumerate(self.deck)}
+        self.position = 0
+        # Don't let a new pass start with the id on the panel, or without one,
+        # the id that ended the last pass
+        self._skip(avoid)
+        self._save_deck()
+
+    def _save_deck(self):
+        self.dirty = False
+        self.generation += 1
+        self._write(
+            self.state_path,
+            {
+                "generation": self.generation,
+                "position": self.position,
+                "deck": self.deck,
+            },
+        )
+        self._save_cursor()
+
+    def _save_cursor(self):
+        self._write(
+            self.cursor_path,
+            {"generation": self.generation, "position": self.position},
+        )
+
+    def _write(self, path, state):
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error("Could not save media rotation state to %s: %s", path, e)
@@ -0,0 +1,115 @@
+from itertools import combinations
+from threading import Lock
+
+from PIL import Image
+
+HASH_BITS = 64
+CHUNK_BITS = 16
+CHUNKS = HASH_BITS // CHUNK_BITS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Largest Hamming distance between two dHashes that still counts as the same
+# photo. Re-encodes and light edits usually land within 2-4 bits; unrelated
+# photos are rarely closer than 15.
+NEAR_DUPLICATE_DISTANCE = 6
+
+
+def dhash(path):
+    """Return the 64-bit difference hash of an image file as an int.
+
+    Each bit records whether a pixel of a 9x8 grayscale thumbnail is brighter
+    than its right-hand neighbour, so the hash survives resizing, recompression
+    and small colour changes.
+    """
+    with Image.open(path) as img:
+        # Let the JPEG decoder downscale while it decodes; only a thumbnail
+        # is needed.
+        img.draft("L", (64, 64))
+        pixels = img.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return value
+
+
+def to_signed(value):
+    """Map an unsigned 64-bit hash onto Postgres' signed BIGINT."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value & ((1 << HASH_BITS) - 1)
+
+
+class NearDuplicateIndex:
+    """In-memory multi-index hashing over 64-bit perceptual hashes.
+
+    Each hash is split into four 16-bit chunks, each with its own table. Two
+    hashes within distance k differ by at most k // 4 bits in at least one
+    chunk, so a lookup only probes the chunk values within that many bits
+    of the query's chunks. The candidates this returns are then checked
+    against the full hash. A lookup takes the same time however large the
+    library gets.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.hashes = {}
+        self.tables = [{} for _ in range(CHUNKS)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, media_id, value):
+        with self.lock:
+            self._remove(media_id)
+            self.hashes[media_id] = value
+            for table, chunk in zip(self.tables, self._chunks(value)):
+                table.setdefault(chunk, set()).add(media_id)
+
+    def remove(self, media_id):
+        with self.lock:
+            self._remove(media_id)
+
+    def find(self, value, max_distance=NEAR_DUPLICATE_DISTANCE):
+        """Return (media_id, distance) pairs within max_distance, closest first."""
+        radius = max_distance // CHUNKS
+        with self.lock:
+            candidates = set()
+            for table, chunk in zip(self.tables, self._chunks(value)):
+                for probe in self._neighbours(chunk, radius):
+                    candidates.update(table.get(probe, ()))
+
+            matches = []
+            for media_id in candidates:
+                distance = bin(self.hashes[media_id] ^ value).count("1")
+                if distance <= max_distance:
+                    matches.append((media_id, distance))
+        return sorted(matches, key=lambda match: match[1])
+
+    def _remove(self, media_id):
+        value = self.hashes.pop(media_id, None)
+        if value is None:
+            return
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            ids = table[chunk]
+            ids.discard(media_id)
+            if not ids:
+                del table[chunk]
+
+    @staticmethod
+    def _chunks(value):
+        return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+    @staticmethod
+    def _neighbours(chunk, radius):
+        yield chunk
+        for flips in range(1, radius + 1):
+            for bits in combinations(range(CHUNK_BITS), flips):
+                probe = chunk
+                for bit in bits:
+                    probe ^= 1 << bit
+                yield probe
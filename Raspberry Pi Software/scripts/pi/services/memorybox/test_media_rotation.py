@@ -0,0 +1,61 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from media_rotation import MediaRotation
+
+
+class MediaRotationTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1234)
+        self.dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.dir.name, "media_rotation.json")
+        self.rotation = MediaRotation(self.state_path)
+        self.rotation.sync([1, 2, 3, 4])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def saved_deck(self):
+        with open(self.state_path) as f:
+            return json.load(f)["deck"]
+
+    def test_each_pass_shows_every_id_once(self):
+        for _ in range(3):
+            shown = [self.rotation.next() for _ in range(4)]
+            self.assertEqual(sorted(shown), [1, 2, 3, 4])
+
+    def test_reshuffle_does_not_repeat_avoid(self):
+        shown = [self.rotation.next() for _ in range(4)]
+        avoid = shown[-1]
+        # Force the new pass to open with the id on the panel
+        with mock.patch(
+            "media_rotation.random.shuffle",
+            lambda deck: deck.sort(key=lambda media_id: media_id != avoid),
+        ):
+            self.assertNotEqual(self.rotation.next(avoid=avoid), avoid)
+
+    def test_no_immediate_repeats_across_passes(self):
+        current = None
+        for _ in range(40):
+            media_id = self.rotation.next(avoid=current)
+            self.assertNotEqual(media_id, current)
+            current = media_id
+
+    def test_avoid_is_returned_when_it_is_the_only_choice(self):
+        self.rotation.sync([7])
+        self.assertEqual(self.rotation.next(avoid=7), 7)
+
+    def test_add_is_saved_by_the_next_pick(self):
+        self.rotation.add(5)
+        self.assertNotIn(5, self.saved_deck())
+        self.rotation.next()
+        self.assertIn(5, self.saved_deck())
+        self.assertIn(5, MediaRotation(self.state_path).deck)
+
+
+if __name__ == "__main__":
+    unittest.main()
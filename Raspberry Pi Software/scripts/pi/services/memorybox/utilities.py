@@ -45,3 +45,13 @@ def compute_md5(file_path):
         while chunk := f.read(8192):
             file_hash.update(chunk)
     return file_hash.hexdigest()
+
+
+def save_stream(stream, file_path, chunk_size=65536):
+    """Copy a file-like object to file_path, returning the SHA-256 of its bytes."""
+    file_hash = hashlib.sha256()
+    with open(file_path, "wb") as f:
+        while chunk := stream.read(chunk_size):
+            file_hash.update(chunk)
+            f.write(chunk)
+    return file_hash.hexdigest()
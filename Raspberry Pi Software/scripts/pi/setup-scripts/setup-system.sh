@@ -28,6 +28,7 @@ sudo apt -y install git
 pip install smbus
 pip install Wand
 pip install Pillow
+pip install numpy
 
 pip install psycopg2
 pip install Flask